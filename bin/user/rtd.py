@@ -24,38 +24,34 @@ Version: 0.1.0                                          Date: 4 October 2021
         - initial release
 """
 # python imports
-import copy
+import bisect
+import collections
 import datetime
-import errno
-import json
+import http.client
+import itertools
 import logging
 import math
 import os
 import os.path
+import queue
+import shutil
 import socket
 import sys
+import tempfile
 import threading
 import time
-
-from operator import itemgetter
-
-# Python 2/3 compatibility shims
-from six.moves import http_client
-from six.moves import queue
-from six.moves import urllib
+import urllib.parse
 
 # WeeWX imports
-import user.gaugedata
 import weewx
 import weeutil.logger
 import weeutil.rsyncupload
 import weeutil.weeutil
 import weewx.units
-import weewx.wxformulas
 
 from weewx.engine import StdService
-from weewx.units import ValueTuple, convert, getStandardUnitType, ListOfDicts, as_value_tuple, _getUnitGroup
-from weeutil.weeutil import get_object#, to_bool, to_int
+from weewx.units import ValueTuple, getStandardUnitType, ListOfDicts
+from weeutil.weeutil import get_object, to_bool, to_int
 
 # get a logger object
 log = logging.getLogger(__name__)
@@ -72,8 +68,24 @@ MANIFEST = ['outTemp', 'barometer', 'outHumidity', 'rain', 'rainRate',
             'appTemp', 'dewpoint', 'windDir', 'UV', 'radiation', 'wind',
             'windGust', 'windGustDir', 'windrun']
 
-# obs for which we need a history
-HIST_MANIFEST = ['windSpeed', 'windDir', 'windGust', 'wind']
+# obs for which we need a history, a frozenset as it is only ever used for
+# membership tests
+HIST_MANIFEST = frozenset(['windSpeed', 'windDir', 'windGust', 'wind'])
+
+# degree/radian conversion factors, multiplying by these avoids the function
+# call overhead of math.radians() and math.degrees()
+DEG2RAD = math.pi / 180.0
+RAD2DEG = 180.0 / math.pi
+
+# windrun calculation parameters for each unit system, the scale to convert
+# windSpeed multiplied by seconds to distance and the distance unit
+WINDRUN_PARAMS = {weewx.US: (1 / 3600.0, 'mile'),
+                  weewx.METRIC: (1 / 3600.0, 'km'),
+                  weewx.METRICWX: (1.0, 'meter')}
+
+# cache of unit conversion functions keyed by (units, unit group, target unit
+# system), refer get_std_converter()
+STD_CONVERTERS = {}
 
 
 # ============================================================================
@@ -92,9 +104,12 @@ class RealtimeData(StdService):
 
     dor that generates gauge-data.txt. Class
     RealtimeGaugeData feeds the RealtimeGaugeDataThread object with data via an
-    instance of queue.Queue.
+    instance of queue.SimpleQueue.
     """
 
+    # query used to obtain the alltime min and max of an obs type
+    MINMAX_SQL = "SELECT MIN(min), MAX(max) FROM %(table_name)s_day_%(obs_type)s"
+
     def __init__(self, engine, config_dict):
         # initialize my superclass
         super(RealtimeData, self).__init__(engine, config_dict)
@@ -104,6 +119,9 @@ class RealtimeData(StdService):
         # create an empty list to hold information on the generators we are
         # using
         self.generators = []
+        # the bound put() method of each generator's control queue, each loop
+        # packet is put to every control queue
+        self.control_puts = []
         # get the RealtimeData config dictionary
         rtd_config_dict = config_dict.get('RealtimeData', {})
         # get a manager dict so we can access the database
@@ -121,8 +139,6 @@ class RealtimeData(StdService):
         # obtain a Buffer object
         self.buffer = Buffer(MANIFEST,
                              weeutil.weeutil.TimeSpan(start_ts, end_ts))
-        self.buffer['fred'] = 23
-        log.info("self.buffer=%s" % (self.buffer,))
         # now get our generator objects
         for generator in rtd_config_dict.sections:
             self.generator_factory(generator,
@@ -149,11 +165,11 @@ class RealtimeData(StdService):
                 self.buffer.std_unit_system = today_stats.get('unit_system')
                 self.buffer.seed(today_stats)
             # now we can start the generators
-            for thread in self.generators:
-                thread['object'].start()
+            for generator in self.generators:
+                generator.thread.start()
             # bind ourself to the relevant WeeWX events
             self.bind(weewx.NEW_LOOP_PACKET, self.new_loop_packet)
-            # self.bind(weewx.NEW_ARCHIVE_RECORD, self.new_archive_record)
+            self.bind(weewx.NEW_ARCHIVE_RECORD, self.new_archive_record)
             # get a CachedPacket object as our loop packet cache
             self.packet_cache = CachedPacket()
             # if we have a non-None value for our Buffer unit system set our
@@ -173,9 +189,10 @@ class RealtimeData(StdService):
             log.info("Unknown generator '%s' specified. Ignoring." % generator)
             return
         # we have a valid generator class name so create queues for passing
-        # data to and controlling the thread
-        control_queue = queue.Queue()
-        result_queue = queue.Queue()
+        # data to and controlling the thread, we need nothing more than put()
+        # and get() so use the lighter weight SimpleQueue
+        control_queue = queue.SimpleQueue()
+        result_queue = queue.SimpleQueue()
         # now get the generator object
         generator_obj = get_object(generator_class)(control_queue=control_queue,
                                                     result_queue=result_queue,
@@ -184,40 +201,64 @@ class RealtimeData(StdService):
                                                     manager_dict=self.manager_dict,
                                                     engine=engine,
                                                     buffer=self.buffer,
-                                                    lock=self.buffer.lock)
-        # finally add our generator object and
-        self.generators.append({'object': generator_obj,
-                                'control_queue': control_queue,
-                                'result_queue': result_queue})
+                                                    buffer_lock=self.buffer.lock)
+        # finally add our generator object and its queues
+        self.generators.append(GeneratorEntry(generator_obj,
+                                              control_queue,
+                                              result_queue))
+        self.control_puts.append(control_queue.put)
 
     def new_loop_packet(self, event):
         """Puts new loop packets in the rtgd queue."""
 
+        packet = event.packet
+        packet_cache = self.packet_cache
         # update the buffer with the loop packet
 #         log.info("pre-add buffer=%s" % (self.buffer,))
-        self.buffer.add_packet(event.packet)
+        self.buffer.add_packet(packet)
 #         log.info("post-add buffer=%s" % (self.buffer,))
         # Our Buffer object unit system has now been set but what about our
         # packet cache? If not set then set it the same as the Buffer objects.
-        if self.packet_cache.std_unit_system is None:
-            self.packet_cache.std_unit_system = self.buffer.std_unit_system
+        if packet_cache.std_unit_system is None:
+            packet_cache.std_unit_system = self.buffer.std_unit_system
         # update the packet cache
-        self.packet_cache.update(event.packet, event.packet['dateTime'])
+        packet_cache.update(packet)
         # get a cached packet
-        _cached_packet = self.packet_cache.get_packet(ts=event.packet['dateTime'])
+        _cached_packet = packet_cache.get_packet(ts=packet['dateTime'])
         # package the loop packet in a dict since this is not the only data
-        # we send via the queue
+        # we send via the queue, the same package is queued to every
+        # generator so generators must not modify it
         _package = {'type': 'loop',
                     'payload': _cached_packet}
         # now put it in the queue for each generator
-        for thread in self.generators:
-            thread['control_queue'].put(_package)
+        for put in self.control_puts:
+            put(_package)
         # do any logging that may be required
         if weewx.debug == 2:
             log.debug("queued cached loop packet (%s)" % _package['payload']['dateTime'])
         elif weewx.debug >= 3:
             log.debug("queued cached loop packet: %s" % _package['payload'])
 
+    def new_archive_record(self, event):
+        """Puts new archive records in the rtgd queue.
+
+        We run as a report service so the archive record has been saved to
+        the database by the time we see it.
+        """
+
+        # package the archive record in a dict, the same package is queued to
+        # every generator so generators must not modify it
+        _package = {'type': 'archive',
+                    'payload': event.record}
+        # now put it in the queue for each generator
+        for put in self.control_puts:
+            put(_package)
+        # do any logging that may be required
+        if weewx.debug == 2:
+            log.debug("queued archive record (%s)" % _package['payload']['dateTime'])
+        elif weewx.debug >= 3:
+            log.debug("queued archive record: %s" % _package['payload'])
+
     def shutDown(self):
         """Shut down any generators.
 
@@ -230,24 +271,24 @@ class RealtimeData(StdService):
         # iterate over our generators and if the generator thread is alive send
         # it the shutdown signal
         for generator in self.generators:
-            if generator['thread'].is_alive():
+            if generator.thread.is_alive():
                 # put a None in the control queue to signal to the thread to
                 # shutdown
-                generator['control_queue'].put(None)
+                generator.control_queue.put(None)
         # now iterate over our generators again waiting for up to 15 seconds
         # for the generator thread to close. The generator threads should all
         # close at about the same time, so there should not be a wait of much
         # longer than 15 seconds unless they all failed to close!
         for generator in self.generators:
             # is the generator thread alive?
-            if generator['thread'].is_alive():
+            if generator.thread.is_alive():
                 # wait up to 15 seconds for the thread to close
-                generator['thread'].join(15.0)
+                generator.thread.join(15.0)
                 # log a short message about closure
-                if generator['thread'].is_alive():
-                    log.error("Unable to shut down '%s' thread" % generator['thread'].name)
+                if generator.thread.is_alive():
+                    log.error("Unable to shut down '%s' thread" % generator.thread.name)
                 else:
-                    log.debug("Shut down '%s' thread." % generator['thread'].name)
+                    log.debug("Shut down '%s' thread." % generator.thread.name)
 
     def get_minmax_obs(self, obs_type):
         """Obtain the alltime max/min values for an observation."""
@@ -255,10 +296,8 @@ class RealtimeData(StdService):
         # create an interpolation dict
         inter_dict = {'table_name': self.db_manager.table_name,
                       'obs_type': obs_type}
-        # the query to be used
-        minmax_sql = "SELECT MIN(min), MAX(max) FROM %(table_name)s_day_%(obs_type)s"
         # execute the query
-        _row = self.db_manager.getSql(minmax_sql % inter_dict)
+        _row = self.db_manager.getSql(RealtimeData.MINMAX_SQL % inter_dict)
         if not _row or None in _row:
             return {'min_%s' % obs_type: None,
                     'max_%s' % obs_type: None}
@@ -282,7 +321,15 @@ class RealtimeData(StdService):
 # ============================================================================
 
 class ObservationBuffer(object):
-    """Base class to buffer an observation."""
+    """Base class to buffer an observation.
+
+    Obs buffers are updated on every loop packet so they, and their child
+    classes, use __slots__ for faster attribute access.
+    """
+
+    __slots__ = ('units', 'last', 'lasttime', 'use_history', 'history_full',
+                 'history_ts', 'history_values', 'history_sum',
+                 'history_removed')
 
     def __init__(self, stats, units=None, history=False):
         self.units = units
@@ -291,7 +338,18 @@ class ObservationBuffer(object):
         if history:
             self.use_history = True
             self.history_full = False
-            self.history = []
+            # History is held in timestamp order as a pair of parallel deques,
+            # one of timestamps and one of values, so that old samples can be
+            # discarded from the left in O(1) and no per-sample tuple need be
+            # created.
+            self.history_ts = collections.deque()
+            self.history_values = collections.deque()
+            # running sum of the history values, maintained as values are
+            # added to and removed from the history
+            self.history_sum = 0.0
+            # number of values removed from the history since the running
+            # sum was last recalculated
+            self.history_removed = 0
         else:
             self.use_history = False
 
@@ -310,10 +368,61 @@ class ObservationBuffer(object):
 
         # calc ts of oldest sample we want to retain
         oldest_ts = ts - MAX_AGE
-        # set history_full property
-        self.history_full = min([a.ts for a in self.history if a.ts is not None]) <= oldest_ts
-        # remove any values older than oldest_ts
-        self.history = [s for s in self.history if s.ts > oldest_ts]
+        history_ts = self.history_ts
+        history_values = self.history_values
+        # The oldest sample is always leftmost so there is nothing to do
+        # unless it has expired. If it has then our history has spanned
+        # MAX_AGE so set the history_full property, once set it remains set.
+        if history_ts and history_ts[0] <= oldest_ts:
+            self.history_full = True
+            remove_history = self.remove_history
+            # remove any values older than oldest_ts
+            while history_ts and history_ts[0] <= oldest_ts:
+                history_ts.popleft()
+                remove_history(history_values.popleft())
+
+    def remove_history(self, value):
+        """Account for a value that has been removed from the history."""
+
+        pass
+
+    def history_index(self, ts):
+        """Return the position in my history at which to insert a sample.
+
+        Samples normally arrive in timestamp order and are appended to my
+        history, but a sample may arrive out of order (eg from a driver that
+        does not emit loop packets in timestamp order). Such a sample must be
+        inserted so that my history remains in timestamp order,
+        trim_history(), recent_count() and the history aggregates all rely
+        on it.
+
+        Inputs:
+            ts: the timestamp of the sample to be inserted
+
+        Returns:
+            The position at which the sample is to be inserted, after any
+            samples with the same timestamp.
+        """
+
+        return bisect.bisect_right(self.history_ts, ts)
+
+    def recent_count(self, born):
+        """Return the number of samples in my history born at or after born.
+
+        The history is held in timestamp order so the samples concerned are
+        the newest samples in the history.
+
+        Inputs:
+            born: the timestamp of the oldest sample to be counted
+
+        Returns:
+            The number of samples concerned.
+        """
+
+        history_ts = self.history_ts
+        if len(history_ts) == 0 or history_ts[0] >= born:
+            return len(history_ts)
+        return len(history_ts) - bisect.bisect_left(history_ts, born)
 
     def history_max(self, ts, age=MAX_AGE):
         """Return the max value in my history.
@@ -326,16 +435,22 @@ class ObservationBuffer(object):
             age: the max age of the records being searched
 
         Returns:
-            An object of type ObsTuple where value is a 3 way tuple of
-            (value, x component, y component) and ts is the timestamp when
-            it occurred.
+            An object of type ObsTuple where value is the max value and ts is
+            the timestamp when it occurred. If the max value occurred more
+            than once the earliest occurrence is used. None is returned if
+            there are no samples in the last age seconds.
         """
 
-        born = ts - age
-        snapshot = [a for a in self.history if a.ts >= born]
-        if len(snapshot) > 0:
-            _max = max(snapshot, key=itemgetter(1))
-            return ObsTuple(_max[0], _max[1])
+        count = self.recent_count(ts - age)
+        if count > 0:
+            # The samples concerned are the newest count samples, find the max
+            # value and then the (earliest) position of that value so we can
+            # obtain its timestamp. The samples are read from the newest end
+            # of the history so that older samples need not be skipped over.
+            values = self.history_values
+            start = len(values) - count
+            _max = max(itertools.islice(reversed(values), count))
+            return ObsTuple(_max, self.history_ts[values.index(_max, start)])
         else:
             return None
 
@@ -355,12 +470,20 @@ class ObservationBuffer(object):
             it occurred.
         """
 
-        born = ts - age
-        snapshot = [a.value for a in self.history if a.ts >= born]
-        if len(snapshot) > 0:
-            return float(sum(snapshot)/len(snapshot))
-        else:
+        count = self.recent_count(ts - age)
+        if count == 0:
             return None
+        values = self.history_values
+        older = len(values) - count
+        # if all of our history is within the period concerned we can use the
+        # running sum rather than summing the history
+        if older == 0:
+            return float(self.history_sum / count)
+        # Otherwise sum whichever is the shorter, the samples concerned or the
+        # older samples, the latter are deducted from the running sum.
+        if older < count:
+            return float((self.history_sum - sum(itertools.islice(values, older))) / count)
+        return float(sum(itertools.islice(reversed(values), count)) / count)
 
 
 # ============================================================================
@@ -370,11 +493,24 @@ class ObservationBuffer(object):
 class VectorBuffer(ObservationBuffer):
     """Class to buffer vector observations."""
 
-    default_init = (None, None, None, None, None, 0.0, 0.0, 0.0, 0.0, 0)
+    __slots__ = ('history_xsum', 'history_ysum', 'history_dir', 'history_x',
+                 'history_y', 'min', 'mintime', 'max', 'max_dir', 'maxtime',
+                 'sum', 'xsum', 'ysum', 'sumtime', 'count')
 
     def __init__(self, stats, units=None, history=False):
         # initialize my superclass
         super(VectorBuffer, self).__init__(stats, units=units, history=history)
+        # running sums of the x and y components of the history vectors
+        self.history_xsum = 0.0
+        self.history_ysum = 0.0
+        if history:
+            # the direction and the x and y components of each history
+            # vector, held in parallel with the history so they can be used
+            # without unpacking each vector and the components need only be
+            # calculated once
+            self.history_dir = collections.deque()
+            self.history_x = collections.deque()
+            self.history_y = collections.deque()
 
         if stats:
             self.min = stats.min
@@ -388,59 +524,135 @@ class VectorBuffer(ObservationBuffer):
             self.sumtime = stats.sumtime
             self.count = stats.count
         else:
-            (self.min, self.mintime,
-             self.max, self.max_dir,
-             self.maxtime, self.sum,
-             self.xsum, self.ysum,
-             self.sumtime, self.count) = VectorBuffer.default_init
+            self.day_reset()
 
     def add_value(self, val, ts, hilo=True):
         """Add a value to my hilo and history stats as required."""
 
-        if val.mag is not None:
+        # unpack the vector once only
+        mag, _dir = val
+        if mag is not None:
             if hilo:
-                if self.min is None or val.mag < self.min:
-                    self.min = val.mag
+                if self.min is None or mag < self.min:
+                    self.min = mag
                     self.mintime = ts
-                if self.max is None or val.mag > self.max:
-                    self.max = val.mag
-                    self.max_dir = val.dir
+                if self.max is None or mag > self.max:
+                    self.max = mag
+                    self.max_dir = _dir
                     self.maxtime = ts
-            self.sum += val.mag
-            if self.lasttime:
-                self.sumtime += ts - self.lasttime
-            if val.dir is not None:
-                self.xsum += val.mag * math.cos(math.radians(90.0 - val.dir))
-                self.ysum += val.mag * math.sin(math.radians(90.0 - val.dir))
-            if self.lasttime is None or ts >= self.lasttime:
+            self.sum += mag
+            lasttime = self.lasttime
+            if lasttime:
+                self.sumtime += ts - lasttime
+            if _dir is not None:
+                # The x and y components are used for both the day and history
+                # sums so calculate them once only. They are saved in the
+                # history so no trig is needed when aggregating the history.
+                _rad = (90.0 - _dir) * DEG2RAD
+                _x = mag * math.cos(_rad)
+                _y = mag * math.sin(_rad)
+                self.xsum += _x
+                self.ysum += _y
+            # loop packets arrive in timestamp order so this is almost always
+            # true, a lasttime of None (no previous value) also passes
+            if ts >= (lasttime or ts):
                 self.last = val
                 self.lasttime = ts
             self.count += 1
-            if self.use_history and val.dir is not None:
-                self.history.append(ObsTuple(val, ts))
-                self.trim_history(ts)
+            if self.use_history:
+                history_ts = self.history_ts
+                if _dir is not None:
+                    if history_ts and ts < history_ts[-1]:
+                        # an out of order sample
+                        self.insert_history(ts, val, _dir, _x, _y)
+                    else:
+                        history_ts.append(ts)
+                        self.history_values.append(val)
+                        self.history_dir.append(_dir)
+                        self.history_x.append(_x)
+                        self.history_y.append(_y)
+                    self.history_xsum += _x
+                    self.history_ysum += _y
+                # Only trim the history if the oldest sample has expired. This
+                # is checked even if the value has no direction and so was not
+                # added to the history, otherwise during a calm spell (no
+                # direction) the history would retain expired vectors.
+                if history_ts and history_ts[0] <= ts - MAX_AGE:
+                    self.trim_history(ts)
+
+    def insert_history(self, ts, val, _dir, _x, _y):
+        """Insert an out of order vector into my history in timestamp order."""
+
+        i = self.history_index(ts)
+        self.history_ts.insert(i, ts)
+        self.history_values.insert(i, val)
+        self.history_dir.insert(i, _dir)
+        self.history_x.insert(i, _x)
+        self.history_y.insert(i, _y)
+
+    def remove_history(self, value):
+        """Remove a value from the history x and y component running sums."""
+
+        # the direction and x and y components of the value removed are the
+        # oldest we hold
+        self.history_dir.popleft()
+        _x = self.history_x.popleft()
+        _y = self.history_y.popleft()
+        if self.history_values:
+            self.history_xsum -= _x
+            self.history_ysum -= _y
+            self.history_removed += 1
+            # as for scalar buffers recalculate the running sums exactly once
+            # the whole history has turned over
+            if self.history_removed >= len(self.history_values):
+                self.history_xsum = math.fsum(self.history_x)
+                self.history_ysum = math.fsum(self.history_y)
+                self.history_removed = 0
+        else:
+            # the history is empty, reset the running sums so that any
+            # accumulated rounding error is discarded
+            self.history_xsum = 0.0
+            self.history_ysum = 0.0
+            self.history_removed = 0
 
     def day_reset(self):
         """Reset the vector obs buffer."""
 
-        (self.min, self.mintime,
-         self.max, self.max_dir,
-         self.maxtime, self.sum,
-         self.xsum, self.ysum,
-         self.sumtime, self.count) = VectorBuffer.default_init
+        self.min = None
+        self.mintime = None
+        self.max = None
+        self.max_dir = None
+        self.maxtime = None
+        self.sum = 0.0
+        self.xsum = 0.0
+        self.ysum = 0.0
+        self.sumtime = 0.0
+        self.count = 0
 
     @property
     def day_vec_avg(self):
         """The day average vector."""
 
         try:
-            _magnitude = math.sqrt((self.xsum**2 + self.ysum**2) / self.sumtime**2)
+            _magnitude = math.hypot(self.xsum, self.ysum) / abs(self.sumtime)
         except ZeroDivisionError:
-            return VectorTuple(0.0, 0.0)
-        _direction = 90.0 - math.degrees(math.atan2(self.ysum, self.xsum))
-        _direction = _direction if _direction >= 0.0 else _direction + 360.0
+            return ZERO_VECTOR
+        # the modulo maps the compass direction into the range 0 to 360
+        _direction = (90.0 - math.atan2(self.ysum, self.xsum) * RAD2DEG) % 360.0
         return VectorTuple(_magnitude, _direction)
 
+    @property
+    def day_vec_dir(self):
+        """The day average vector direction.
+
+        The same as the direction of day_vec_avg but without calculating the
+        magnitude.
+        """
+
+        if not self.sumtime:
+            return 0.0
+        return (90.0 - math.atan2(self.ysum, self.xsum) * RAD2DEG) % 360.0
+
     @property
     def history_vec_avg(self):
         """The history average vector.
@@ -450,15 +662,19 @@ class VectorBuffer(ObservationBuffer):
         """
 
         # TODO. Check the maths here, time ?
-        result = VectorTuple(None, None)
-        if self.use_history and len(self.history) > 0:
-            xy = [self.calc_xy(obs.value) for obs in self.history]
-            xsum = sum(x for x, y in xy)
-            ysum = sum(y for x, y in xy)
-            oldest_ts = min(ob.ts for ob in self.history)
-            _magnitude = math.sqrt((xsum**2 + ysum**2) / (time.time() - oldest_ts)**2)
-            _direction = 90.0 - math.degrees(math.atan2(ysum, xsum))
-            _direction = _direction if _direction >= 0.0 else _direction + 360.0
+        result = NULL_VECTOR
+        if self.use_history and len(self.history_ts) > 0:
+            xsum = self.history_xsum
+            ysum = self.history_ysum
+            # The history is in timestamp order so the oldest is leftmost and
+            # the newest rightmost. The period is measured using the sample
+            # timestamps rather than the system clock, so it is unaffected by
+            # any difference between the station and system clocks or a
+            # system clock step. If the period is zero (ie we have a single
+            # sample) there is no magnitude.
+            _period = self.history_ts[-1] - self.history_ts[0]
+            _magnitude = math.hypot(xsum, ysum) / _period if _period > 0 else 0.0
+            _direction = (90.0 - math.atan2(ysum, xsum) * RAD2DEG) % 360.0
             result = VectorTuple(_magnitude, _direction)
         return result
 
@@ -471,27 +687,12 @@ class VectorBuffer(ObservationBuffer):
         """
 
         result = None
-        if self.use_history and len(self.history) > 0:
-            xy = [self.calc_xy(obs.value) for obs in self.history]
-            xsum = sum(x for x, y in xy)
-            ysum = sum(y for x, y in xy)
-            _direction = 90.0 - math.degrees(math.atan2(ysum, xsum))
-            result = _direction if _direction >= 0.0 else _direction + 360.0
+        if self.use_history and len(self.history_ts) > 0:
+            xsum = self.history_xsum
+            ysum = self.history_ysum
+            result = (90.0 - math.atan2(ysum, xsum) * RAD2DEG) % 360.0
         return result
 
-    @staticmethod
-    def calc_xy(vector):
-        """Given a vector observation value calculate the x and y components.
-
-        Inputs:
-            vector: a
-
-        Returns a two way tuple in the format (x, y)
-        """
-
-        return (vector.mag * math.cos(math.radians(90.0 - vector.dir)),
-                vector.mag * math.sin(math.radians(90.0 - vector.dir)))
-
 
 # ============================================================================
 #                             class ScalarBuffer
@@ -500,11 +701,20 @@ class VectorBuffer(ObservationBuffer):
 class ScalarBuffer(ObservationBuffer):
     """Class to buffer scalar observations."""
 
-    default_init = (None, None, None, None, 0.0, 0)
+    __slots__ = ('history_maxq', 'min', 'mintime', 'max', 'maxtime', 'sum',
+                 'count')
 
     def __init__(self, stats, units=None, history=False):
         # initialize my superclass
         super(ScalarBuffer, self).__init__(stats, units=units, history=history)
+        if history:
+            # The candidates for the history max as (value, ts) tuples in
+            # timestamp order. Each candidate is greater than all later
+            # candidates, so the leftmost is the (earliest) max of the history.
+            # A value added to the history removes any lesser candidates as
+            # they can no longer be the max, expired candidates are removed as
+            # the history is trimmed.
+            self.history_maxq = collections.deque()
 
         if stats:
             self.min = stats.min
@@ -514,9 +724,7 @@ class ScalarBuffer(ObservationBuffer):
             self.sum = stats.sum
             self.count = stats.count
         else:
-            (self.min, self.mintime,
-             self.max, self.maxtime,
-             self.sum, self.count) = ScalarBuffer.default_init
+            self.day_reset()
 
     def add_value(self, val, ts, hilo=True):
         """Add a value to my stats as required."""
@@ -530,20 +738,89 @@ class ScalarBuffer(ObservationBuffer):
                     self.max = val
                     self.maxtime = ts
             self.sum += val
-            if self.lasttime is None or ts >= self.lasttime:
+            # loop packets arrive in timestamp order so this is almost always
+            # true, a lasttime of None (no previous value) also passes
+            if ts >= (self.lasttime or ts):
                 self.last = val
                 self.lasttime = ts
             self.count += 1
             if self.use_history:
-                self.history.append(ObsTuple(val, ts))
-                self.trim_history(ts)
+                if self.history_ts and ts < self.history_ts[-1]:
+                    # an out of order sample
+                    self.insert_history(ts, val)
+                else:
+                    self.history_ts.append(ts)
+                    self.history_values.append(val)
+                    maxq = self.history_maxq
+                    while maxq and maxq[-1][0] < val:
+                        maxq.pop()
+                    maxq.append((val, ts))
+                self.history_sum += val
+                # only trim the history if the oldest sample has expired
+                if self.history_ts[0] <= ts - MAX_AGE:
+                    self.trim_history(ts)
+
+    def insert_history(self, ts, val):
+        """Insert an out of order value into my history in timestamp order."""
+
+        i = self.history_index(ts)
+        self.history_ts.insert(i, ts)
+        self.history_values.insert(i, val)
+        # the value may displace candidates either side of it, out of order
+        # values are rare so rebuild the max candidates from the history
+        maxq = collections.deque()
+        for item in zip(self.history_values, self.history_ts):
+            while maxq and maxq[-1][0] < item[0]:
+                maxq.pop()
+            maxq.append(item)
+        self.history_maxq = maxq
+
+    def history_max(self, ts, age=MAX_AGE):
+        """Return the max value in my history.
+
+        As per ObservationBuffer.history_max() but if the period concerned
+        includes my whole history the max is my leftmost max candidate.
+        """
+
+        count = self.recent_count(ts - age)
+        if count > 0 and count == len(self.history_ts):
+            return ObsTuple(*self.history_maxq[0])
+        return super(ScalarBuffer, self).history_max(ts, age)
+
+    def remove_history(self, value):
+        """Remove a value from the history running sum and max candidates."""
+
+        maxq = self.history_maxq
+        if self.history_values:
+            # discard any max candidates older than our oldest sample
+            oldest_ts = self.history_ts[0]
+            while maxq and maxq[0][1] < oldest_ts:
+                maxq.popleft()
+            self.history_sum -= value
+            self.history_removed += 1
+            # Rounding error accumulates in the running sum as values are
+            # added and removed. Once the whole history has turned over
+            # recalculate the running sum exactly, this costs one pass over
+            # the history per history length of removals.
+            if self.history_removed >= len(self.history_values):
+                self.history_sum = math.fsum(self.history_values)
+                self.history_removed = 0
+        else:
+            # the history is empty, reset the running sum so that any
+            # accumulated rounding error is discarded
+            self.history_sum = 0.0
+            self.history_removed = 0
+            maxq.clear()
 
     def day_reset(self):
         """Reset the scalar obs buffer."""
 
-        (self.min, self.mintime,
-         self.max, self.maxtime,
-         self.sum, self.count) = ScalarBuffer.default_init
+        self.min = None
+        self.mintime = None
+        self.max = None
+        self.maxtime = None
+        self.sum = 0.0
+        self.count = 0
 
 
 # ============================================================================
@@ -560,32 +837,60 @@ class Buffer(dict):
     archive record is written to archive will not be captured. For this reason
     selected loop data is buffered to ensure that such stats are correctly
     reflected.
+
+    Obs buffers are held as dict items keyed by obs name so they can be
+    accessed directly by the generators (eg buffer['windSpeed']). Item
+    access on a dict subclass is done in C, wrapping a dict attribute instead
+    would need Python level __getitem__ and __contains__ methods. Our own
+    attributes are held in slots rather than an instance dict. Obs buffers
+    should only be added or accessed while holding our lock.
     """
 
+    __slots__ = ('lock', 'manifest', 'add_funcs', 'value_adders', 'timespan',
+                 'last_windSpeed_ts', 'last_rain_ts', 'std_unit_system')
+
     def __init__(self, manifest, timespan):
         """Initialise an instance of our class."""
 
         # TODO. Do we need to call our parent?
         self.lock = threading.Lock()
-        self.manifest = manifest
+        # the manifest is only ever used for membership tests and iteration so
+        # keep it as a set
+        self.manifest = frozenset(manifest)
+        # the function used to add each manifest obs to the buffer, looked up
+        # once only rather than for every obs in every packet
+        self.add_funcs = dict((obs, add_functions.get(obs, Buffer.add_value))
+                              for obs in self.manifest)
+        # the units and bound add_value() method of each obs buffer we hold,
+        # maintained as obs buffers are set
+        self.value_adders = dict()
         self.timespan = timespan
         # timestamp of the last packet containing windSpeed, used for windrun
         # calculations
         self.last_windSpeed_ts = None
+        # timestamp of the last loop packet containing a rain tip, None if no
+        # rain has been seen since we started
+        self.last_rain_ts = None
         self.std_unit_system = None
 
+    def __setitem__(self, obs, obs_buffer):
+        """Set an obs buffer and save its units and add_value() method."""
+
+        super(Buffer, self).__setitem__(obs, obs_buffer)
+        self.value_adders[obs] = (obs_buffer.units, obs_buffer.add_value)
+
     def seed(self, stats):
         """Seed a buffer object with daily stats."""
 
         # Iterate over each observation type in the daily stats that is also in
-        # our manifest. Obtain the seed function to use and call it.
-        for obs_type in [f for f in stats if f in self.manifest]:
-            # obtain the seed function
-            seed_func = seed_functions.get(obs_type, Buffer.seed_scalar)
-            # call it
-            self.lock.acquire()
-            seed_func(self, stats, obs_type, history=obs_type in HIST_MANIFEST)
-            self.lock.release()
+        # our manifest. Obtain the seed function to use and call it. Seeding is
+        # done under a single acquisition of our lock.
+        with self.lock:
+            for obs_type in self.manifest.intersection(stats):
+                # obtain the seed function
+                seed_func = seed_functions.get(obs_type, Buffer.seed_scalar)
+                # call it
+                seed_func(self, stats, obs_type, history=obs_type in HIST_MANIFEST)
 
     def seed_scalar(self, stats, obs_type, history):
         """Seed a scalar buffer."""
@@ -604,37 +909,68 @@ class Buffer(dict):
     def add_packet(self, packet):
         """Add a packet to the buffer."""
 
-        if packet['dateTime'] is not None:
-            if not self.timespan.includesArchiveTime(packet['dateTime']):
-                self.lock.acquire()
-                self.start_of_day_reset()
-                self.lock.release()
-            if self.std_unit_system is None:
-                self.lock.acquire()
-                self.std_unit_system = packet['usUnits']
-                self.lock.release()
-            _conv_packet = weewx.units.to_std_system(packet, self.std_unit_system)
-            for obs in [f for f in _conv_packet if f in self.manifest]:
-                add_func = add_functions.get(obs, Buffer.add_value)
-                self.lock.acquire()
-                add_func(self, _conv_packet, obs)
-                self.lock.release()
+        ts = packet['dateTime']
+        if ts is not None:
+            us_units = packet['usUnits']
+            # the packet is added under a single acquisition of our lock, the
+            # context manager ensures the lock is released should an error
+            # occur
+            with self.lock:
+                if not self.timespan.includesArchiveTime(ts):
+                    self.start_of_day_reset()
+                    # move on to the day that includes this packet so that we
+                    # reset once per day rather than on every packet
+                    self.timespan = weeutil.weeutil.archiveDaySpan(ts)
+                std_unit_system = self.std_unit_system
+                if std_unit_system is None:
+                    self.std_unit_system = std_unit_system = us_units
+                # we need only those packet obs that are in our manifest
+                obs_list = self.manifest.intersection(packet)
+                if us_units == std_unit_system:
+                    _conv_packet = packet
+                else:
+                    # convert only the obs we need rather than the whole packet
+                    _packet = dict((obs, packet[obs]) for obs in obs_list)
+                    _packet['dateTime'] = ts
+                    _packet['usUnits'] = us_units
+                    _conv_packet = weewx.units.to_std_system(_packet, std_unit_system)
+                add_funcs = self.add_funcs
+                for obs in obs_list:
+                    add_funcs[obs](self, _conv_packet, obs)
 
     def add_value(self, packet, obs):
         """Add a value to the buffer."""
 
-        # if we haven't seen this obs before add it to our buffer
-        if obs not in self:
+        us_units = packet['usUnits']
+        try:
+            units, add = self.value_adders[obs]
+        except KeyError:
+            # we haven't seen this obs before so add it to our buffer
             self[obs] = init_dict.get(obs, ScalarBuffer)(stats=None,
-                                                         units=packet['usUnits'],
+                                                         units=us_units,
                                                          history=obs in HIST_MANIFEST)
-        if self[obs].units == packet['usUnits']:
+            units, add = self.value_adders[obs]
+        # the packet has been converted to our unit system so usually there
+        # is no need to convert, only obs buffers seeded from the database
+        # may use different units
+        if units == us_units:
             _value = packet[obs]
         else:
-            (unit, group) = getStandardUnitType(packet['usUnits'], obs)
-            _vt = ValueTuple(packet[obs], unit, group)
-            _value = weewx.units.convertStd(_vt, self[obs].units).value
-        self[obs].add_value(_value, packet['dateTime'])
+            (unit, group) = getStandardUnitType(us_units, obs)
+            _value = get_std_converter(unit, group, units)(packet[obs])
+        add(_value, packet['dateTime'])
+
+    def add_rain_value(self, packet, obs):
+        """Add a rain value to the buffer."""
+
+        # first add it as a scalar
+        self.add_value(packet, obs)
+
+        # every loop packet is added to the buffer so this is where we see
+        # every rain tip, note the time of the tip
+        _rain = packet[obs]
+        if _rain is not None and _rain > 0:
+            self.last_rain_ts = packet['dateTime']
 
     def add_wind_value(self, packet, obs):
         """Add a wind value to the buffer."""
@@ -646,29 +982,32 @@ class Buffer(dict):
         # can use windSpeed to update windrun
         if 'windrun' not in packet and obs == 'windSpeed':
             # has windrun been seen before, if not add it to the Buffer
-            if 'windrun' not in self:
-                self['windrun'] = init_dict.get(obs, ScalarBuffer)(stats=None,
-                                                                   units=packet['usUnits'],
-                                                                   history=obs in HIST_MANIFEST)
+            windrun_buffer = self.get('windrun')
+            if windrun_buffer is None:
+                windrun_buffer = init_dict.get(obs, ScalarBuffer)(stats=None,
+                                                                  units=packet['usUnits'],
+                                                                  history=obs in HIST_MANIFEST)
+                self['windrun'] = windrun_buffer
             # to calculate windrun we need a speed over a period of time, are
             # we able to calculate the length of the time period?
             if self.last_windSpeed_ts is not None:
                 windrun = self.calc_windrun(packet)
-                self['windrun'].add_value(windrun, packet['dateTime'])
+                windrun_buffer.add_value(windrun, packet['dateTime'])
             self.last_windSpeed_ts = packet['dateTime']
 
         # now add it as the special vector 'wind'
         if obs == 'windSpeed':
-            if 'wind' not in self:
-                self['wind'] = VectorBuffer(stats=None, units=packet['usUnits'])
-            if self['wind'].units == packet['usUnits']:
+            wind_buffer = self.get('wind')
+            if wind_buffer is None:
+                wind_buffer = VectorBuffer(stats=None, units=packet['usUnits'])
+                self['wind'] = wind_buffer
+            if wind_buffer.units == packet['usUnits']:
                 _value = packet['windSpeed']
             else:
                 (unit, group) = getStandardUnitType(packet['usUnits'], 'windSpeed')
-                _vt = ValueTuple(packet['windSpeed'], unit, group)
-                _value = weewx.units.convertStd(_vt, self['wind'].units).value
-            self['wind'].add_value(VectorTuple(_value, packet.get('windDir')),
-                                   packet['dateTime'])
+                _value = get_std_converter(unit, group, wind_buffer.units)(packet['windSpeed'])
+            wind_buffer.add_value(VectorTuple(_value, packet.get('windDir')),
+                                  packet['dateTime'])
 
     def start_of_day_reset(self):
         """Reset our buffer stats at the end of an archive period.
@@ -677,27 +1016,29 @@ class Buffer(dict):
         kept longer than the end of the archive period.
         """
 
-        for obs in self.manifest:
-            self[obs].day_reset()
+        # only reset the obs buffers we actually hold, an obs in our manifest
+        # may not have been seen yet
+        for obs_buffer in self.values():
+            obs_buffer.day_reset()
 
     def calc_windrun(self, packet):
         """Calculate windrun given windSpeed."""
 
-        val = None
-        if packet['usUnits'] == weewx.US:
-            val = packet['windSpeed'] * (packet['dateTime'] - self.last_windSpeed_ts) / 3600.0
-            unit = 'mile'
-        elif packet['usUnits'] == weewx.METRIC:
-            val = packet['windSpeed'] * (packet['dateTime'] - self.last_windSpeed_ts) / 3600.0
-            unit = 'km'
-        elif packet['usUnits'] == weewx.METRICWX:
-            val = packet['windSpeed'] * (packet['dateTime'] - self.last_windSpeed_ts)
-            unit = 'meter'
-        if self['windrun'].units == packet['usUnits']:
+        # obtain the speed to distance per second scale and distance unit for
+        # the packet unit system
+        try:
+            scale, unit = WINDRUN_PARAMS[packet['usUnits']]
+        except KeyError:
+            # we don't know this unit system so we cannot calculate windrun
+            return None
+        if packet['windSpeed'] is None:
+            return None
+        val = packet['windSpeed'] * (packet['dateTime'] - self.last_windSpeed_ts) * scale
+        windrun_units = self['windrun'].units
+        if windrun_units == packet['usUnits']:
             return val
         else:
-            _vt = ValueTuple(val, unit, 'group_distance')
-            return weewx.units.convertStd(_vt, self['windrun'].units).value
+            return get_std_converter(unit, 'group_distance', windrun_units)(val)
 
 
 # ============================================================================
@@ -705,7 +1046,8 @@ class Buffer(dict):
 # ============================================================================
 
 init_dict = ListOfDicts({'wind': VectorBuffer})
-add_functions = ListOfDicts({'windSpeed': Buffer.add_wind_value})
+add_functions = ListOfDicts({'windSpeed': Buffer.add_wind_value,
+                             'rain': Buffer.add_rain_value})
 seed_functions = ListOfDicts({'wind': Buffer.seed_vector})
 
 
@@ -727,19 +1069,11 @@ seed_functions = ListOfDicts({'wind': Buffer.seed_vector})
 #
 # It is also valid to have a ts of None (meaning there is no information about
 # the time the was was observed.
+#
+# A namedtuple is used as its named attributes are implemented in C rather
+# than as Python properties.
 
-class ObsTuple(tuple):
-
-    def __new__(cls, *args):
-        return tuple.__new__(cls, args)
-
-    @property
-    def value(self):
-        return self[0]
-
-    @property
-    def ts(self):
-        return self[1]
+ObsTuple = collections.namedtuple('ObsTuple', ('value', 'ts'))
 
 
 # ============================================================================
@@ -755,19 +1089,30 @@ class ObsTuple(tuple):
 #    1    dir        The direction of the vector in degrees
 #
 # mag and dir may be None
+#
+# As for ObsTuple a namedtuple is used for its C implemented named attributes.
 
-class VectorTuple(tuple):
+VectorTuple = collections.namedtuple('VectorTuple', ('mag', 'dir'))
 
-    def __new__(cls, *args):
-        return tuple.__new__(cls, args)
+# vector tuples are immutable so the fixed results of the vector average
+# properties can be shared rather than created on each call
+NULL_VECTOR = VectorTuple(None, None)
+ZERO_VECTOR = VectorTuple(0.0, 0.0)
 
-    @property
-    def mag(self):
-        return self[0]
 
-    @property
-    def dir(self):
-        return self[1]
+# ============================================================================
+#                            class GeneratorEntry
+# ============================================================================
+
+# RealtimeData holds a generator entry for each generator it runs.
+#
+# Item   attribute       Meaning
+#    0    thread         The generator thread object
+#    1    control_queue  The queue used to pass data to and control the thread
+#    2    result_queue   The queue used to pass results back from the thread
+
+GeneratorEntry = collections.namedtuple('GeneratorEntry',
+                                        ('thread', 'control_queue', 'result_queue'))
 
 
 # ============================================================================
@@ -786,110 +1131,248 @@ class CachedPacket(object):
     is missing an essential field, or overly complex code in method calculate()
     if field caching was to occur.
 
-    The cache consists of a dictionary of value, timestamp pairs where
-    timestamp is the timestamp of the packet when obs was last seen and value
-    is the value of the obs at that time. None values may be cached.
+    The cache consists of a pair of parallel dictionaries keyed by obs, one
+    holding the value of the obs and the other the timestamp of the packet
+    when the obs was last seen. None values may be cached. An obs is always
+    added to both dictionaries together and never removed, so the two
+    dictionaries hold their keys in the same order and can be iterated in
+    step without looking up each key.
 
     A cached loop packet may be obtained by calling the get_packet() method.
     """
 
-    # These fields must be available in every loop packet read from the
-    # cache.
-    OBS = ["cloudbase", "windDir", "windrun", "inHumidity", "outHumidity",
-           "barometer", "radiation", "rain", "rainRate", "windSpeed",
-           "appTemp", "dewpoint", "heatindex", "humidex", "inTemp",
-           "outTemp", "windchill", "UV", "maxSolarRad"]
     # fields we ignore when caching a packet
-    IGNORE = ['dateTime', 'usUnits']
+    IGNORE = frozenset(['dateTime', 'usUnits'])
 
-    def __init__(self, rec=None):
+    def __init__(self):
         """Initialise our cache object.
 
-        The cache needs to be initialised to include all of the fields required
-        by method calculate(). We could initialise all field values to None
-        (method calculate() will interpret the None values to be '0' in most
-        cases). The result on the gauge display may be misleading. We can get
-        ballpark values for all fields by priming them with values from the
-        last archive record. As the archive may have many more fields than rtgd
-        requires, only prime those fields that rtgd requires.
-
-        This approach does have the drawback that in situations where the
-        archive unit system is different to the loop packet unit system the
-        entire loop packet will be converted each time the cache is updated.
-        This is inefficient.
+        The cache starts empty and is populated from loop packets as they are
+        received.
+
+        Values and timestamps are held in separate flat dicts (rather than a
+        dict of value/timestamp entries) so updating an obs allocates nothing
+        and reading an obs value needs no nested lookup.
+
+        Where the cache unit system is different to the loop packet unit
+        system the loop packet will be converted each time the cache is
+        updated. Packets already in the cache unit system are cached as is.
         """
 
+        # the cached obs values and the timestamps when they were last seen
         self.cache = dict()
-        if rec is not None:
-            # if we have a dateTime field in our record block use that otherwise
-            # use the current system time
-            _ts = rec['dateTime'] if 'dateTime' in rec else int(time.time() + 0.5)
-            # add the packet to the cache
-            self.update(rec, _ts)
-        else:
-            # set the cache unit system if known
-            self.std_unit_system = None
+        self.cache_ts = dict()
+        # the cache unit system, adopted from the first packet added to the
+        # cache unless set beforehand
+        self.std_unit_system = None
 
-    def update(self, packet, ts):
+    def update(self, packet):
         """Update the cache from a loop packet.
 
         If the loop packet uses a different unit system to that of the cache
         then convert the loop packet before adding it to the cache. Update any
         previously seen cache fields and add any loop fields that have not been
-        seen before.
+        seen before. The cached fields are timestamped with the packet
+        dateTime, or the current system time if the packet has no dateTime.
         """
 
+        ts = packet.get('dateTime')
+        if ts is None:
+            ts = int(time.time() + 0.5)
+        us_units = packet['usUnits']
+        std_unit_system = self.std_unit_system
         # does our cache have a non-None unit system?
-        if self.std_unit_system is None:
+        if std_unit_system is None:
             # we have no unit system so adopt the unit system of the packet
-            self.std_unit_system = packet['usUnits']
-        # convert our packet to the cache's unit system
-        _conv_packet = weewx.units.to_std_system(packet, self.std_unit_system)
-        # iterate over the obs in the packet that we cache and update the cache
-        # as required
-        for obs in [x for x in _conv_packet if x not in CachedPacket.IGNORE]:
-            # we only add non-None observations to the cache
-            if _conv_packet[obs] is not None:
-                # add the observation value and it's 'timestamp' to the cache
-                self.cache[obs] = {'value': _conv_packet[obs], 'ts': ts}
-
-    def get_value(self, obs, ts, max_age):
-        """Get an obs value from the cache.
-
-        Return a value for a given obs from the cache. If the value is older
-        than max_age then None is returned.
-        """
-
-        if obs in self.cache and ts - self.cache[obs]['ts'] <= max_age:
-            return self.cache[obs]['value']
-        return None
+            self.std_unit_system = std_unit_system = us_units
+        # convert our packet to the cache's unit system, there is nothing to
+        # convert if the packet already uses the cache's unit system
+        if us_units == std_unit_system:
+            _conv_packet = packet
+        else:
+            _conv_packet = weewx.units.to_std_system(packet, std_unit_system)
+        # obtain the obs in the packet that we cache, we only add non-None
+        # observations to the cache
+        ignore = CachedPacket.IGNORE
+        fresh = {obs: value for obs, value in _conv_packet.items()
+                 if value is not None and obs not in ignore}
+        # add the observation values and their 'timestamp' to the cache, both
+        # dicts are updated from fresh so any new obs are added to each in the
+        # same order
+        self.cache.update(fresh)
+        self.cache_ts.update(dict.fromkeys(fresh, ts))
 
     def get_packet(self, ts=None, max_age=600):
         """Get a loop packet from the cache.
 
         Resulting packet may contain None values.
+
+        A new packet is returned on each call. The packet is queued to every
+        generator thread and a generator may still be using it when the next
+        packet is obtained, so a single packet cannot be reused. The packet
+        is shared by the generators and must be treated as read only.
         """
 
         if ts is None:
             ts = int(time.time() + 0.5)
-        packet = {'dateTime': ts, 'usUnits': self.std_unit_system}
-        for obs in self.cache:
-            packet[obs] = self.get_value(obs, ts, max_age)
+        # The packet is handed to other threads so it must be a new dict, but
+        # the cached values are never mutated so a shallow copy suffices.
+        # Copying the cache dict is done in C and creates the packet at its
+        # final size, any values older than max_age are then set to None.
+        cache = self.cache
+        cache_ts = self.cache_ts
+        oldest_ts = ts - max_age
+        packet = dict(cache)
+        # Usually every obs has been seen within max_age, min() finds this in
+        # C so the obs need only be checked one by one if one has expired.
+        # Expired obs are kept in the cache (with a None value in the packet)
+        # as the packet must always include every obs seen.
+        if cache_ts and min(cache_ts.values()) < oldest_ts:
+            for obs, obs_ts in zip(cache, cache_ts.values()):
+                if obs_ts < oldest_ts:
+                    packet[obs] = None
+        packet['dateTime'] = ts
+        packet['usUnits'] = self.std_unit_system
         return packet
 
 
+# ============================================================================
+#                            class ThreadedExport
+# ============================================================================
+
+class ThreadedExport(object):
+    """Base class for exporters that export data in their own thread.
+
+    An export may block for some time (eg a slow or unreachable remote
+    server). Rather than blocking the generator thread data is handed to a
+    worker thread that performs the export. Only the most recent data is kept,
+    if the worker falls behind any data not yet exported is replaced by the
+    fresher data rather than being queued. Exports may also be limited to one
+    every interval seconds, data received in the meantime is coalesced so that
+    only the most recent data is exported.
+
+    Child classes must override the do_export() method and may override the
+    close() method to release any resources held by the worker thread.
+    """
+
+    def __init__(self):
+
+        # condition used to hand data to the worker thread
+        self.condition = threading.Condition()
+        # the data waiting to be exported, None if there is nothing waiting
+        self.pending = None
+        # the minimum number of seconds between exports, 0 means export as
+        # soon as data is available
+        self.interval = 0
+        # monotonic time of the last export
+        self.last_export = None
+        # set when our worker thread is to exit
+        self.stop = False
+        # our worker thread, it is not started until there is something to
+        # export so an exporter that never exports does not hold a thread
+        self.worker = None
+
+    def export(self, data, ts):
+        """Hand data to the worker thread for export.
+
+        Any data that is still waiting to be exported is discarded. The
+        worker thread is started on the first export.
+
+        Inputs:
+            data: the serialised data to be exported as bytes
+            ts:   the timestamp of the packet from which data was generated
+        """
+
+        with self.condition:
+            if self.worker is None and not self.stop:
+                self.worker = threading.Thread(target=self.run,
+                                               name=self.__class__.__name__)
+                self.worker.daemon = True
+                self.worker.start()
+            self.pending = (data, ts)
+            self.condition.notify()
+
+    def shut_down(self, timeout=5.0):
+        """Stop the worker thread.
+
+        Any data still waiting to be exported is discarded. An export that is
+        in progress is allowed to complete, but we wait no more than timeout
+        seconds for the worker thread to exit.
+        """
+
+        with self.condition:
+            self.stop = True
+            self.condition.notify()
+        if self.worker is None:
+            # there is no worker to close our resources so do it ourself
+            self.close()
+            return
+        self.worker.join(timeout)
+        if self.worker.is_alive():
+            log.error("Unable to shut down '%s' thread" % self.worker.name)
+
+    def run(self):
+        """Worker thread loop, export the latest data as it becomes available."""
+
+        try:
+            while True:
+                with self.condition:
+                    while self.pending is None and not self.stop:
+                        self.condition.wait()
+                    # If we are limiting the export rate wait until interval
+                    # seconds have passed since the last export. Any data
+                    # received while we wait replaces the pending data.
+                    if self.interval and self.last_export is not None:
+                        _wait = self.last_export + self.interval - time.monotonic()
+                        while _wait > 0 and not self.stop:
+                            self.condition.wait(_wait)
+                            _wait = self.last_export + self.interval - time.monotonic()
+                    if self.stop:
+                        return
+                    (data, ts), self.pending = self.pending, None
+                self.last_export = time.monotonic()
+                # an export failure must not kill the worker thread
+                try:
+                    self.do_export(data, ts)
+                except Exception as e:
+                    log.error("%s: Unexpected exception during export: %s" % (self.worker.name, e))
+                    weeutil.logger.log_traceback(log.debug, '    ****  ')
+        finally:
+            self.close()
+
+    def do_export(self, data, ts):
+        """Export the data.
+
+        This method is called by the worker thread and should be overridden
+        in each child class to perform the actual export.
+
+        Inputs:
+            data: the serialised data to be exported as bytes
+            ts:   the timestamp of the packet from which data was generated
+        """
+
+        pass
+
+    def close(self):
+        """Release any resources held by the worker thread."""
+
+        pass
+
+
 # ============================================================================
 #                            class HttpPostExport
 # ============================================================================
 
-class HttpPostExport(object):
+class HttpPostExport(ThreadedExport):
     """Class to handle HTTP posting of gauge-data.txt.
 
     Once initialised data is posted by calling the objects export method and
-    passing the data to be posted.
+    passing the data to be posted. The post is made in a separate thread.
     """
 
     def __init__(self, rtgd_config_dict, *_):
+        # initialize my superclass
+        super(HttpPostExport, self).__init__()
 
         # first find our config
         if 'HttpPost' in rtgd_config_dict:
@@ -902,12 +1385,36 @@ class HttpPostExport(object):
         self.timeout = to_int(post_config_dict.get('timeout', 2))
         # response text from remote URL if post was successful
         self.response = post_config_dict.get('response_text', None)
+        # minimum interval in seconds between posts
+        self.interval = to_int(post_config_dict.get('export_interval', 0))
+        # Split the remote URL into its components once only. Posts are made
+        # over a single persistent (keep-alive) connection to the remote
+        # server rather than opening a new connection for every post.
+        if self.remote_server_url is not None:
+            _url = urllib.parse.urlsplit(self.remote_server_url)
+            self.scheme = _url.scheme.lower()
+            self.netloc = _url.netloc
+            self.path = urllib.parse.urlunsplit(('', '', _url.path or '/',
+                                                 _url.query, ''))
+        else:
+            self.scheme = self.netloc = self.path = None
+        # the persistent connection, created on first use
+        self.connection = None
+        # the headers sent with every post
+        self.headers = {'Content-Type': 'application/json'}
 
-    def export(self, data):
+    def do_export(self, data, ts):
         """Post the data."""
 
         self.post_data(data)
 
+    def close(self):
+        """Close our persistent connection if we have one."""
+
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
     def post_data(self, data):
         """Post data to a remote URL via HTTP POST.
 
@@ -916,33 +1423,27 @@ class HttpPostExport(object):
         remote posts are not working then the user should set debug=1 and
         restart WeeWX to see what the log says.
 
-        The data to be posted is sent as a JSON string.
+        The data to be posted is the JSON formatted data as written to
+        gauge-data.txt, it is posted as is without being serialised again.
 
         Inputs:
-            data: dict to sent as JSON string
+            data: JSON formatted data to be posted as bytes
         """
 
-        # get a Request object
-        req = urllib.request.Request(self.remote_server_url)
-        # set our content type to json
-        req.add_header('Content-Type', 'application/json')
         # POST the data but wrap in a try..except so we can trap any errors
         try:
-            response = self.post_request(req, json.dumps(data,
-                                                         separators=(',', ':'),
-                                                         sort_keys=True))
-        except (urllib.error.URLError, socket.error,
-                http_client.BadStatusLine, http_client.IncompleteRead) as e:
+            code, body = self.post_request(data)
+        except (socket.error, http.client.HTTPException) as e:
             # an exception was thrown, log it and continue
             log.debug("Failed to post data: %s" % e)
         else:
-            if 200 <= response.code <= 299:
+            if 200 <= code <= 299:
                 # No exception thrown and we got a good response code, but did
                 # we get self.response back in a return message? Check for
                 # self.response, if its there then we can return. If it's
                 # not there then log it and return.
                 if self.response is not None:
-                    if self.response in response:
+                    if self.response in body.decode('utf-8', 'replace'):
                         # did get 'success' so log it and continue
                         if weewx.debug == 2:
                             log.debug("Successfully posted data")
@@ -951,24 +1452,45 @@ class HttpPostExport(object):
                         # code of 200 was received if under python3, check
                         # response code and give it the benefit of the doubt
                         # but log it anyway
-                        if response.code == 200:
+                        if code == 200:
                             log.debug("Data may have been posted successfully. "
                                       "Response message was not received but a valid response code was received.")
                         else:
                             log.debug("Failed to post data: Unexpected response")
                 return
             # we received a bad response code, log it and continue
-            log.debug("Failed to post data: Code %s" % response.code())
+            log.debug("Failed to post data: Code %s" % code)
+
+    def get_connection(self):
+        """Obtain the persistent connection to the remote server.
 
-    def post_request(self, request, payload):
-        """Post a Request object.
+        A new connection object is created if we do not have one, otherwise
+        the existing (keep-alive) connection is reused.
+        """
+
+        if self.connection is None:
+            if self.scheme == 'https':
+                self.connection = http.client.HTTPSConnection(self.netloc,
+                                                              timeout=self.timeout)
+            else:
+                self.connection = http.client.HTTPConnection(self.netloc,
+                                                             timeout=self.timeout)
+        return self.connection
+
+    def post_request(self, payload):
+        """Post a payload over the persistent connection.
+
+        If the post fails for any reason the connection is closed and
+        discarded, a new connection will be made on the next post. The
+        remote server may close a kept-alive connection between posts, so a
+        post that fails on a reused connection because the connection was
+        closed is retried once on a new connection.
 
         Inputs:
-            request: urllib2 Request object
             payload: the data to sent
 
         Returns:
-            The urllib2.urlopen() response
+            A two way tuple of the response status code and response body
         """
 
         # Under python 3 POST data should be bytes or an iterable of bytes and
@@ -977,27 +1499,50 @@ class HttpPostExport(object):
         # prepared to catch this error.
         try:
             payload_b = payload.encode('utf-8')
-        except TypeError:
+        except (AttributeError, TypeError):
             payload_b = payload
-        # do the POST
-        _response = urllib.request.urlopen(request,
-                                           data=payload_b,
-                                           timeout=self.timeout)
-        return _response
+        while True:
+            # are we reusing a kept-alive connection
+            reused = self.connection is not None
+            connection = self.get_connection()
+            try:
+                # do the POST
+                connection.request('POST', self.path, body=payload_b,
+                                   headers=self.headers)
+                _response = connection.getresponse()
+                # the response must be read in full before the connection can
+                # be reused
+                _body = _response.read()
+            except (socket.error, http.client.HTTPException) as e:
+                # the connection is in an unknown state so discard it
+                connection.close()
+                self.connection = None
+                # if the server closed a reused connection try again once on a
+                # new connection, otherwise give up
+                if reused and isinstance(e, (http.client.RemoteDisconnected,
+                                             BrokenPipeError,
+                                             ConnectionResetError)):
+                    log.debug("Post on reused connection failed (%s), retrying" % (e,))
+                    continue
+                raise
+            return _response.status, _body
 
 
 # ============================================================================
 #                            class RsyncExport
 # ============================================================================
 
-class RsyncExport(object):
+class RsyncExport(ThreadedExport):
     """Class to handle rsync of gauge-data.txt.
 
     Once initialised data is rsynced by calling the objects export method and
-    passing the data to be rsynced.
+    passing the data to be rsynced. The rsync is performed in a separate
+    thread.
     """
 
     def __init__(self, rtgd_config_dict, rtgd_path_file):
+        # initialize my superclass
+        super(RsyncExport, self).__init__()
 
         # first find our config
         if 'Rsync' in rtgd_config_dict:
@@ -1021,13 +1566,57 @@ class RsyncExport(object):
         self.rsync_timeout = rsync_config_dict.get('rsync_timeout')
         self.rsync_skip_if_older_than = to_int(rsync_config_dict.get('rsync_skip_if_older_than',
                                                                      4))
+        # minimum interval in seconds between rsyncs
+        self.interval = to_int(rsync_config_dict.get('export_interval', 0))
+        # Each rsync invocation would normally incur a full ssh handshake.
+        # Optionally have ssh keep a master connection open for
+        # rsync_ssh_persist seconds after each rsync so that successive rsyncs
+        # reuse it. The default of 0 disables ssh connection sharing.
+        self.rsync_ssh_persist = to_int(rsync_config_dict.get('rsync_ssh_persist',
+                                                              0))
+        # the directory holding the ssh control socket, None if we are not
+        # sharing ssh connections
+        self.control_dir = None
+        if self.rsync_ssh_persist > 0:
+            # anyone who can reach the control socket can use the master
+            # connection so keep it in a private (mode 0700) directory with an
+            # unpredictable name
+            self.control_dir = tempfile.mkdtemp(prefix='rtd-ssh-')
+            _control_path = os.path.join(self.control_dir, '%r@%h:%p')
+            self.rsync_ssh_options = ' '.join([self.rsync_ssh_options,
+                                               '-o ControlMaster=auto',
+                                               '-o ControlPath=%s' % _control_path,
+                                               '-o ControlPersist=%d' % self.rsync_ssh_persist])
+        # the rsync settings do not change so we can use the same RsyncUpload
+        # object for every rsync
+        self.rsync_upload = weeutil.rsyncupload.RsyncUpload(local_root=self.rtgd_path_file,
+                                                            remote_root=self.rsync_dest_path_file,
+                                                            server=self.rsync_server,
+                                                            user=self.rsync_user,
+                                                            port=self.rsync_port,
+                                                            ssh_options=self.rsync_ssh_options,
+                                                            compress=self.rsync_compress,
+                                                            delete=False,
+                                                            log_success=self.rsync_log_success,
+                                                            timeout=self.rsync_timeout)
+
+    def do_export(self, data, ts):
+        """Rsync the data.
+
+        The data has already been written to file, it is the file that is
+        rsynced. The packet timestamp is used to skip stale rsyncs.
+        """
 
-    def export(self, data):
-        """Rsync the data."""
-
-        packet_time = datetime.datetime.fromtimestamp(data['dateTime'])
+        packet_time = datetime.datetime.fromtimestamp(ts)
         self.rsync_data(packet_time)
 
+    def close(self):
+        """Remove our ssh control socket directory if we have one."""
+
+        if self.control_dir is not None:
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+            self.control_dir = None
+
     def rsync_data(self, packet_time):
         """Perform the actual rsync."""
 
@@ -1038,18 +1627,8 @@ class RsyncExport(object):
             if age.total_seconds() > self.rsync_skip_if_older_than:
                 log.info("skipping packet (%s) with age: %d" % (packet_time, age.total_seconds()))
                 return
-        rsync_upload = weeutil.rsyncupload.RsyncUpload(local_root=self.rtgd_path_file,
-                                                       remote_root=self.rsync_dest_path_file,
-                                                       server=self.rsync_server,
-                                                       user=self.rsync_user,
-                                                       port=self.rsync_port,
-                                                       ssh_options=self.rsync_ssh_options,
-                                                       compress=self.rsync_compress,
-                                                       delete=False,
-                                                       log_success=self.rsync_log_success,
-                                                       timeout=self.rsync_timeout)
         try:
-            rsync_upload.run()
+            self.rsync_upload.run()
         except IOError as e:
             (cl, unused_ob, unused_tr) = sys.exc_info()
             log.error("rtgd.rsync_data: Caught exception %s: %s" % (cl, e))
@@ -1109,6 +1688,56 @@ class RealtimeDataThread(threading.Thread):
         return exporter_object
 
 
+# ============================================================================
+#                            Utility Functions
+# ============================================================================
+
+def get_std_converter(unit, group, to_unit_system):
+    """Obtain a function to convert a scalar value to a standard unit system.
+
+    Converting via weewx.units.convertStd() requires a ValueTuple be
+    constructed and the target units and conversion function be looked up on
+    every call. Instead look these up once for each combination of units,
+    unit group and target unit system and save the resulting function for
+    reuse.
+
+    Inputs:
+        unit:           the units of the values to be converted
+        group:          the unit group of the values to be converted
+        to_unit_system: the unit system to convert to
+
+    Returns:
+        A function that accepts a value in unit and returns the value in the
+        units used by to_unit_system for group. None values are returned
+        unchanged.
+    """
+
+    try:
+        return STD_CONVERTERS[(unit, group, to_unit_system)]
+    except KeyError:
+        pass
+    try:
+        to_unit = weewx.units.std_groups[to_unit_system][group]
+    except KeyError:
+        to_unit = None
+    if to_unit is not None and to_unit == unit:
+        def _convert(value):
+            return value
+    else:
+        func = weewx.units.conversionDict.get(unit, {}).get(to_unit)
+        if func is not None:
+            def _convert(value):
+                return func(value) if value is not None else None
+        else:
+            # we have no direct conversion so fall back to convertStd() which
+            # will deal with (and log) any problems
+            def _convert(value):
+                return weewx.units.convertStd(ValueTuple(value, unit, group),
+                                              to_unit_system).value
+    STD_CONVERTERS[(unit, group, to_unit_system)] = _convert
+    return _convert
+
+
 # lookup dict of supported generator classes
-GENERATOR_LOOKUP = {'gaugedata': 'user.gaugedata.GaugeDataThread',
-                    'clientraw': 'user.gaugedata.GaugeDataThread'}
+GENERATOR_LOOKUP = {'gaugedata': 'user.rtgaugedata.GaugeDataThread',
+                    'clientraw': 'user.rtgaugedata.GaugeDataThread'}
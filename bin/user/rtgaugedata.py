@@ -113,6 +113,12 @@ https://github.com/mcrossley/SteelSeries-Weather-Gauges/tree/master/weather_serv
     #                              number of seconds.  Default is 4.  (Skip this
     #                              and move on to the next if this data is older
     #                              than 4 seconds.
+    #   rsync_ssh_persist        : Number of seconds ssh keeps a shared master
+    #                              connection open after an rsync so that
+    #                              later rsyncs avoid a new ssh handshake. The
+    #                              control socket is kept in a private
+    #                              temporary directory. 0 disables connection
+    #                              sharing. Default is 0.
     # Use either the post method or the rsync method, not both.
     #rsync_server = emerald.johnkline.com
     #rsync_user = root
@@ -122,6 +128,14 @@ https://github.com/mcrossley/SteelSeries-Weather-Gauges/tree/master/weather_serv
     #rsync_ssh_options = "-o ConnectTimeout=1"
     #rsync_timeout = 1
     #rsync_skip_if_older_than = 4
+    #rsync_ssh_persist = 60
+
+    # Minimum interval (seconds) between HTTP POSTs or rsyncs of gauge-data.txt.
+    # Any gauge-data.txt generated during the interval is not exported, at the
+    # end of the interval the most recently generated gauge-data.txt is
+    # exported. Useful for slow remote servers. Optional, default is 0 (export
+    # every gauge-data.txt generated).
+    #export_interval = 0
 
     # Minimum interval (seconds) between file generation. Ideally
     # gauge-data.txt would be generated on receipt of every loop packet (there
@@ -428,18 +442,17 @@ Handy things/conditions noted from analysis of SteelSeries Weather Gauges:
 """
 
 # python imports
-import copy
-import datetime
+import array
 import errno
 import json
 import logging
 import os
 import os.path
+import queue
 import threading
 import time
 
-# Python 2/3 compatibility shims
-from six.moves import queue
+from operator import attrgetter
 
 # WeeWX imports
 import user.rtd
@@ -450,7 +463,7 @@ import weeutil.weeutil
 import weewx.units
 import weewx.wxformulas
 
-from weewx.units import ValueTuple, convert, getStandardUnitType, ListOfDicts, as_value_tuple, _getUnitGroup
+from weewx.units import ValueTuple, convert, getStandardUnitType, as_value_tuple, _getUnitGroup
 from weeutil.weeutil import to_bool, to_int
 
 # get a logger object
@@ -461,21 +474,26 @@ RTGD_VERSION = '0.5.0'
 # version number (format) of the generated gauge-data.txt
 GAUGE_DATA_VERSION = '14'
 
+# JSON encoder used to serialise gauge-data.txt. Compact separators and sorted
+# keys, created once rather than on every json.dumps() call. gauge-data.txt
+# data is a flat dict of strings, numbers and lists so there is no need for the
+# encoder to check for circular references.
+JSON_ENCODER = json.JSONEncoder(separators=(',', ':'), sort_keys=True,
+                                check_circular=False)
+
 # ordinal compass points supported
 COMPASS_POINTS = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE',
-                  'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW', 'N']
+                  'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW']
 
 # default units to use
 # Default to Metric with speed in 'km_per_hour' and rain in 'mm'.
 # weewx.units.MetricUnits is close but we need to change the rain units (we
 # could use MetricWX but then we would need to change the speed units!)
-# start by making a deepcopy
-_UNITS = copy.deepcopy(weewx.units.MetricUnits)
-# now set the group_rain and group_rainrate units
-_UNITS['group_rain'] = 'mm'
-_UNITS['group_rainrate'] = 'mm_per_hour'
-# now assign to our defaults
-DEFAULT_UNITS = _UNITS
+# A shallow copy with the group_rain and group_rainrate units overridden is
+# all we need, the unit names are immutable strings.
+DEFAULT_UNITS = dict(weewx.units.MetricUnits,
+                     group_rain='mm',
+                     group_rainrate='mm_per_hour')
 
 # map WeeWX unit names to unit names supported by the SteelSeries Weather
 # Gauges
@@ -521,6 +539,13 @@ STATION_LOST_CONTACT = {'Vantage': {'field': 'rxCheckPercent', 'value': 0},
                         'WS1': {'field': 'rxCheckPercent', 'value': 0},
                         'CC3000': {'field': 'rxCheckPercent', 'value': 0}
                         }
+# cache of unit conversion functions keyed by (from units, to units), refer
+# get_converter()
+CONVERTERS = {}
+
+# field map aggregates that are times rather than values
+TIME_AGGREGATES = ('mintime', 'maxtime', 'lasttime')
+
 # stations supporting lost contact reporting through their archive record
 ARCHIVE_STATIONS = ['Vantage']
 # stations supporting lost contact reporting through their loop packet
@@ -867,7 +892,18 @@ class GaugeDataThread(user.rtd.RealtimeDataThread):
 
         # setup file generation timing
         self.min_interval = my_config_dict.get('min_interval', None)
-        self.last_write = 0  # ts (actual) of last generation
+        # The minimum interval in nanoseconds, generation is gated against
+        # the monotonic clock so is immune to any system clock steps. A
+        # minimum interval that is omitted, empty or not greater than 0 means
+        # generate on every loop packet, in which case there is no gate at
+        # all.
+        try:
+            self.min_interval_ns = int(float(self.min_interval) * 1000000000)
+        except (TypeError, ValueError):
+            self.min_interval_ns = None
+        if self.min_interval_ns is not None and self.min_interval_ns <= 0:
+            self.min_interval_ns = None
+        self.last_write = None  # monotonic ns of last generation
 
         # get our file paths and names
         _path = my_config_dict.get('rtgd_path', '/var/tmp')
@@ -879,6 +915,30 @@ class GaugeDataThread(user.rtd.RealtimeDataThread):
                                          my_config_dict.get('rtgd_file_name',
                                                                 'gauge-data.txt'))
         self.gd_path_file_tmp = self.gd_path_file + '.tmp'
+        # the last gauge-data.txt content written
+        self.last_payload = None
+        # any package taken from the control queue that is yet to be processed
+        self.held_packages = []
+        # the weewx debug level, it is fixed for the life of the thread so
+        # take a copy rather than looking it up for every log call
+        self.debug = int(weewx.debug)
+        # the last timestamp for which the timeUTC and date fields were
+        # formatted along with the formatted fields
+        self.time_strings = (None, None, None)
+        # the packet barometer units and all time low and high barometer for
+        # which the pressL and pressH fields were formatted along with the
+        # formatted fields
+        self.press_strings = (None, None, None)
+        # archive records used for trend calculations for the current packet
+        # keyed by (timestamp, grace)
+        self.trend_records = {}
+        # the sources of all trend fields, populated as the field map is
+        # compiled
+        self.trend_sources = set()
+        # the query used to obtain trend records and the columns it returns,
+        # constructed once we have a db manager
+        self.trend_sql = None
+        self.trend_columns = None
 
         # get windrose settings, default to 1 day(= 86400 seconds)
         try:
@@ -931,6 +991,14 @@ class GaugeDataThread(user.rtd.RealtimeDataThread):
         self.alt_group = my_config_dict['Groups'].get('group_altitude',
                                                       'meter')
         self.flag_format = '%.0f'
+        # The non-field map fields are formatted every packet so obtain a
+        # formatter for each format string once only, as is done for field
+        # map fields.
+        self.pres_formatter = compile_format(self.pres_format)
+        self.wind_formatter = compile_format(self.wind_format)
+        self.rain_formatter = compile_format(self.rain_format)
+        self.dir_formatter = compile_format(self.dir_format)
+        self.flag_formatter = compile_format(self.flag_format)
 
         # set up output units dict
         # first get the Groups config from our config dict
@@ -940,15 +1008,32 @@ class GaugeDataThread(user.rtd.RealtimeDataThread):
         # picked up from the defaults.
         if 'group_rain' in _config_units_dict:
             _config_units_dict['group_rainrate'] = "%s_per_hour" % (_config_units_dict['group_rain'],)
-        # add the Groups config to the chainmap and set the units_dict property
-        self.units_dict = ListOfDicts(_config_units_dict, DEFAULT_UNITS)
-        # setup the field map
-        _field_map = my_config_dict.get('FieldMap', DEFAULT_FIELD_MAP)
+        # Set the units_dict property. Neither the Groups config nor the
+        # defaults change once we are running so rather than chain the two
+        # dicts take a snapshot of the defaults updated with the Groups config.
+        self.units_dict = dict(DEFAULT_UNITS)
+        self.units_dict.update(_config_units_dict)
+        # Setup the field map. The field map entries are normalised below, so
+        # take our own copy of each entry rather than change the config or
+        # the module level default field map, both of which may be shared
+        # with other generators.
+        _field_map = dict((field, dict(field_config)) for field, field_config
+                          in my_config_dict.get('FieldMap', DEFAULT_FIELD_MAP).items())
         # update the field map with any extensions
         _extensions = my_config_dict.get('FieldMapExtensions', {})
-        # update the field map with any extensions
-        _field_map.update(_extensions)
-
+        _field_map.update((field, dict(field_config)) for field, field_config
+                          in _extensions.items())
+
+        # The field names and resolvers in field map order. Field map based
+        # fields are populated from these rather than by iterating over the
+        # field map for every packet.
+        _resolvers = []
+        # Fields without a source are always None so they need not be
+        # resolved for every packet.
+        _null_fields = {}
+        # The unique sources used by the field map in field map order. These
+        # are the sources for which we need packet unit details.
+        _sources = []
         # convert any defaults to ValueTuples
         for field in list(_field_map.items()):
             field_config = field[1]
@@ -967,7 +1052,43 @@ class GaugeDataThread(user.rtd.RealtimeDataThread):
                 # we already have a ValueTuple so nothing to do
                 _vt = _default
             _field_map[field[0]]['default'] = _vt
-        self.field_map = _field_map
+            # Normalise any aggregate period and grace period once only. An
+            # aggregate period is either an int number of seconds or a lower
+            # case string (eg 'day'), a grace period is an int number of
+            # seconds.
+            if field_config.get('aggregate_period') is not None:
+                try:
+                    _period = int(field_config['aggregate_period'])
+                except ValueError:
+                    _period = field_config['aggregate_period'].lower()
+                _field_map[field[0]]['aggregate_period'] = _period
+            if field_config.get('grace_period') is not None:
+                _field_map[field[0]]['grace_period'] = int(field_config['grace_period'])
+            if _field_map[field[0]]['source'] is None:
+                _null_fields[field[0]] = None
+                continue
+            # compile the format string into a callable once only rather than
+            # interpreting the format on every packet
+            _formatter = compile_format(field_config['format'],
+                                        field_config.get('aggregate'))
+            # and likewise resolve the field map entry into a function that
+            # obtains the field value
+            _resolvers.append((field[0], self.compile_field(_field_map[field[0]],
+                                                            _formatter)))
+            if _field_map[field[0]]['source'] not in _sources:
+                _sources.append(_field_map[field[0]]['source'])
+        self.field_resolvers = tuple(_resolvers)
+        self.null_fields = _null_fields
+        # add windSpeed and rain to our sources, they are used by non-field
+        # map based field calculations
+        for source in ('windSpeed', 'rain'):
+            if source not in _sources:
+                _sources.append(source)
+        self.unit_sources = tuple(_sources)
+        # packet unit details for the unit sources keyed by unit system
+        self.unit_system_units = {}
+        # the trend field sources are now known, freeze them in a fixed order
+        self.trend_sources = tuple(sorted(self.trend_sources))
 
         # get max cache age
         self.max_cache_age = my_config_dict.get('max_cache_age', 600)
@@ -987,6 +1108,15 @@ class GaugeDataThread(user.rtd.RealtimeDataThread):
                                                               False))
         # set the lost contact flag, assume we start off with contact
         self.lost_contact_flag = False
+        # resolve the lost contact field and value for our station type once
+        # only, both are None if our station type is not supported
+        _lost_contact = STATION_LOST_CONTACT.get(self.station_type, {})
+        self.lost_contact_field = _lost_contact.get('field')
+        self.lost_contact_value = _lost_contact.get('value')
+        # our station type and whether we ignore lost contact do not change so
+        # obtain the lost contact check for each packet type once only
+        self.lost_contact_checks = {'loop': self.compile_lost_contact('loop'),
+                                    'archive': self.compile_lost_contact('archive')}
 
         # initialise the packet unit dict
         self.packet_unit_dict = None
@@ -1003,6 +1133,10 @@ class GaugeDataThread(user.rtd.RealtimeDataThread):
 
         self.rose = None
         self.last_rain_ts = None
+        # the time of last rain last formatted and the formatted result, the
+        # time of last rain of None is a valid time so use a sentinel to force
+        # the first format
+        self.last_rain_tip = (object(), None)
 
         # initialise the scroller text
         self.scroller_text = None
@@ -1020,6 +1154,40 @@ class GaugeDataThread(user.rtd.RealtimeDataThread):
             self.month_rain = None
         if self.ytd_rain:
             self.year_rain = None
+        # Month and year to date rain for completed days only changes at
+        # midnight, so it is obtained from the daily summaries once per day.
+        # Timestamps of the start and end of the day for which the completed
+        # day rain totals were obtained.
+        self.rain_day_start = None
+        self.rain_day_end = None
+        # The start of the day before rain_day_start and that day's rain as
+        # included in the month and year to date rain. The first loop packet
+        # of a new day arrives before the archive record that completes the
+        # previous day has been saved, so the previous day's rain is read
+        # again once that archive record arrives. None once it has been read
+        # again.
+        self.rain_prev_day = None
+
+        # Fields that do not change for the life of the thread, these are
+        # calculated once only.
+        # dateFormat - date format
+        # tempunit - temperature units - C, F
+        # windunit -wind units - m/s, mph, km/h, kts
+        # pressunit - pressure units - mb, hPa, in
+        # rainunit - rain units - mm, in
+        # cloudbaseunit - cloud base units - m, ft
+        # version - weather software version
+        # build -
+        # ver - gauge-data.txt version number
+        self.const_data = {'dateFormat': self.date_format.replace('%', ''),
+                           'tempunit': UNITS_TEMP[self.temp_group],
+                           'windunit': UNITS_WIND[self.wind_group],
+                           'pressunit': UNITS_PRES[self.pres_group],
+                           'rainunit': UNITS_RAIN[self.rain_group],
+                           'cloudbaseunit': UNITS_CLOUD[self.alt_group],
+                           'version': '%s' % weewx.__version__,
+                           'build': '',
+                           'ver': self.version}
 
         # obtain an object for exporting gauge-data.txt if required, if export
         # not required property will be set to None
@@ -1059,6 +1227,20 @@ class GaugeDataThread(user.rtd.RealtimeDataThread):
             # get a db manager
             self.db_manager = weewx.manager.open_manager(self.manager_dict)
 
+            # make sure our destination directory exists so that it need not
+            # be checked on every write
+            self.make_dest_dir()
+
+            # Construct the query used to obtain trend records. The query
+            # selects only the columns needed by our trend fields rather than
+            # a whole record and only selects columns that exist in the
+            # archive.
+            self.trend_columns = ('dateTime', 'usUnits') + \
+                tuple(s for s in self.trend_sources if s in self.db_manager.sqlkeys)
+            self.trend_sql = "SELECT %s FROM %s WHERE dateTime>=? AND dateTime<=? " \
+                             "ORDER BY ABS(dateTime-?) ASC LIMIT 1" % (', '.join(self.trend_columns),
+                                                                        self.db_manager.table_name)
+
             # initialise the time of last rain
             self.last_rain_ts = self.calc_last_rain_stamp()
 
@@ -1068,9 +1250,9 @@ class GaugeDataThread(user.rtd.RealtimeDataThread):
                                       self.db_manager,
                                       self.wr_period,
                                       self.wr_points)
-            if weewx.debug == 2:
+            if self.debug == 2:
                 log.debug("windrose data calculated")
-            elif weewx.debug >= 3:
+            elif self.debug >= 3:
                 log.debug("windrose data calculated: %s" % (self.rose,))
             # setup our loop cache and set some starting wind values
             _ts = self.db_manager.lastGoodStamp()
@@ -1105,14 +1287,14 @@ class GaugeDataThread(user.rtd.RealtimeDataThread):
                             if isinstance(_package, dict):
                                 if 'type' in _package and _package['type'] == 'forecast':
                                     # we have forecast text so log and save it
-                                    if weewx.debug >= 2:
+                                    if self.debug >= 2:
                                         log.debug("received forecast text: %s" % _package['payload'])
                                     self.scroller_text = _package['payload']
                     # now deal with the control queue
                     try:
                         # block for one second waiting for package, if nothing
                         # received throw queue.Empty
-                        _package = self.control_queue.get(True, 1.0)
+                        _package = self.get_package()
                     except queue.Empty:
                         # nothing in the queue so continue
                         pass
@@ -1121,24 +1303,24 @@ class GaugeDataThread(user.rtd.RealtimeDataThread):
                         if _package is None:
                             return
                         elif _package['type'] == 'archive':
-                            if weewx.debug == 2:
+                            if self.debug == 2:
                                 log.debug("received archive record (%s)" % _package['payload']['dateTime'])
-                            elif weewx.debug >= 3:
+                            elif self.debug >= 3:
                                 log.debug("received archive record: %s" % _package['payload'])
                             self.process_new_archive_record(_package['payload'])
                             self.rose = calc_windrose(_package['payload']['dateTime'],
                                                       self.db_manager,
                                                       self.wr_period,
                                                       self.wr_points)
-                            if weewx.debug == 2:
+                            if self.debug == 2:
                                 log.debug("windrose data calculated")
-                            elif weewx.debug >= 3:
+                            elif self.debug >= 3:
                                 log.debug("windrose data calculated: %s" % (self.rose,))
                             continue
                         elif _package['type'] == 'stats':
-                            if weewx.debug == 2:
+                            if self.debug == 2:
                                 log.debug("received stats package")
-                            elif weewx.debug >= 3:
+                            elif self.debug >= 3:
                                 log.debug("received stats package: %s" % _package['payload'])
                             self.process_stats(_package['payload'])
                             continue
@@ -1146,9 +1328,9 @@ class GaugeDataThread(user.rtd.RealtimeDataThread):
                             # we now have a packet to process, wrap in a
                             # try..except so we can catch any errors
                             try:
-                                if weewx.debug == 2:
+                                if self.debug == 2:
                                     log.debug("received loop packet (%s)" % _package['payload']['dateTime'])
-                                elif weewx.debug >= 3:
+                                elif self.debug >= 3:
                                     log.debug("received loop packet: %s" % _package['payload'])
                                 self.process_packet(_package['payload'])
                                 continue
@@ -1159,10 +1341,6 @@ class GaugeDataThread(user.rtd.RealtimeDataThread):
                                 weeutil.logger.log_traceback(log.debug, 'gdthread: **** ')
                                 log.critical("Thread exiting. Reason: %s" % (e, ))
                                 return
-                    # if packets have backed up in the control queue, trim it until
-                    # it's no bigger than the max allowed backlog
-                    while self.control_queue.qsize() > 5:
-                        self.control_queue.get()
         except Exception as e:
             # Some unknown exception occurred. This is probably
             # a serious problem. Exit.
@@ -1170,6 +1348,49 @@ class GaugeDataThread(user.rtd.RealtimeDataThread):
             weeutil.logger.log_traceback(log.debug, 'gdthread: **** ')
             log.critical("Thread exiting. Reason: %s" % (e, ))
             return
+        finally:
+            # we are exiting so stop our exporter's worker thread
+            if self.exporter:
+                self.exporter.shut_down()
+
+    def get_package(self):
+        """Obtain the next package to be processed from the control queue.
+
+        If loop packets have backed up in the control queue only the most
+        recent loop packet is processed, any older loop packets are stale and
+        are discarded. Anything else in the control queue is always processed
+        and in the order received.
+
+        Returns:
+            The next package to process. Raises queue.Empty if nothing was
+            received within one second.
+        """
+
+        # if we held back a package last time it is next
+        if self.held_packages:
+            return self.held_packages.pop()
+        _package = self.control_queue.get(True, 1.0)
+        # if we have a loop packet drain any loop packets that have backed up
+        # behind it
+        if _package is not None and _package['type'] == 'loop':
+            get_nowait = self.control_queue.get_nowait
+            stale = 0
+            while True:
+                try:
+                    _next = get_nowait()
+                except queue.Empty:
+                    break
+                if _next is not None and _next['type'] == 'loop':
+                    stale += 1
+                    _package = _next
+                else:
+                    # not a loop packet so hold it back until the next call
+                    self.held_packages.append(_next)
+                    break
+            if stale and self.debug >= 2:
+                log.debug("%d stale loop packet(s) discarded before (%s)" % (stale,
+                                                                             _package['payload']['dateTime']))
+        return _package
 
     def process_packet(self, packet):
         """Process incoming loop packets and generate gauge-data.txt.
@@ -1179,14 +1400,16 @@ class GaugeDataThread(user.rtd.RealtimeDataThread):
         """
 
         # get time for debug timing
-        t1 = time.time()
-
-        # generate if we have no minimum interval setting or if minimum
-        # interval seconds have elapsed since our last generation
-        if self.min_interval is None or (self.last_write + float(self.min_interval)) < time.time():
-            if weewx.debug == 2:
+        t1 = time.monotonic_ns()
+
+        # generate if we have no minimum interval setting, have not yet
+        # generated or if minimum interval seconds have elapsed since our last
+        # generation
+        if self.min_interval_ns is None or self.last_write is None or \
+                self.last_write + self.min_interval_ns < t1:
+            if self.debug == 2:
                 log.debug("received cached loop packet (%s)" % packet['dateTime'])
-            elif weewx.debug >= 3:
+            elif self.debug >= 3:
                 log.debug("received cached loop packet: %s" % (packet,))
             # # set our lost contact flag if applicable
             # self.lost_contact_flag = self.get_lost_contact(packet, 'loop')
@@ -1199,22 +1422,29 @@ class GaugeDataThread(user.rtd.RealtimeDataThread):
             else:
                 # write to our file
                 try:
-                    self.write_data(data)
+                    written = self.write_data(data)
                 except Exception as e:
                     weeutil.logger.log_traceback(log.info, 'gdthread: **** ')
                 else:
                     # set our write time
-                    self.last_write = time.time()
-                    # export gauge-data.txt if we have an exporter object
-                    if self.exporter:
-                        self.exporter.export(data)
+                    self.last_write = time.monotonic_ns()
+                    # export gauge-data.txt if it changed and we have an
+                    # exporter object
+                    if not written:
+                        if self.debug >= 2:
+                            log.debug("gauge-data.txt (%s) unchanged, not exported" % packet['dateTime'])
+                    elif self.exporter:
+                        # hand over the serialised data that was written to
+                        # file so the exporter need not serialise it again,
+                        # along with the packet timestamp
+                        self.exporter.export(self.last_payload, packet['dateTime'])
                     # log the generation
-                    if weewx.debug == 2:
+                    if self.debug == 2:
                         log.info("gauge-data.txt (%s) generated in %.5f seconds" % (packet['dateTime'],
-                                                                                    (self.last_write - t1)))
+                                                                                    (self.last_write - t1) / 1e9))
         else:
             # we skipped this packet so log it
-            if weewx.debug == 2:
+            if self.debug == 2:
                 log.debug("cached packet (%s) skipped" % packet['dateTime'])
 
     def process_stats(self, package):
@@ -1225,8 +1455,12 @@ class GaugeDataThread(user.rtd.RealtimeDataThread):
         """
 
         if package is not None:
-            for key, value in package.items():
-                setattr(self, key, value)
+            # only accept the stats we know about, anything else would add
+            # arbitrary attributes to our object
+            if 'min_barometer' in package:
+                self.min_barometer = package['min_barometer']
+            if 'max_barometer' in package:
+                self.max_barometer = package['max_barometer']
 
     def write_data(self, data):
         """Write the gauge-data.txt file.
@@ -1237,10 +1471,52 @@ class GaugeDataThread(user.rtd.RealtimeDataThread):
         file is used to lessen chance of rtgd/web server file access conflict.
         Destination directory is created if it does not exist.
 
+        If the serialised data is identical to that last written the file is
+        left untouched.
+
         Inputs:
             data: dictionary of gauge-data.txt data elements
+
+        Returns:
+            True if the file was written, False if the data was unchanged.
         """
 
+        # serialise the data in one go so the temporary file can be written
+        # with a single buffered write rather than many small writes
+        payload = JSON_ENCODER.encode(data).encode('utf-8')
+        # if nothing has changed since our last write there is nothing to do
+        if payload == self.last_payload:
+            return False
+        # Open the temporary file. The destination directory is made when we
+        # start so only try to make the destination directory again if the
+        # open fails because it does not exist.
+        _flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        try:
+            fd = os.open(self.gd_path_file_tmp, _flags, 0o644)
+        except OSError as error:
+            # raise if the error is anything other than a missing directory
+            if error.errno != errno.ENOENT:
+                raise
+            self.make_dest_dir()
+            fd = os.open(self.gd_path_file_tmp, _flags, 0o644)
+        # now write to temporary file
+        try:
+            view = memoryview(payload)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+        # and move the temporary file to our destination, the replace is
+        # atomic so readers never see a partially written file and unlike
+        # os.rename() it overwrites an existing destination on all platforms
+        os.replace(self.gd_path_file_tmp, self.gd_path_file)
+        # save the payload so we can detect unchanged data next time
+        self.last_payload = payload
+        return True
+
+    def make_dest_dir(self):
+        """Make the gauge-data.txt destination directory if it does not exist."""
+
         # make the destination directory, wrapping it in a try block to catch
         # any errors
         try:
@@ -1249,110 +1525,193 @@ class GaugeDataThread(user.rtd.RealtimeDataThread):
             # raise if the error is anything other than the dir already exists
             if error.errno != errno.EEXIST:
                 raise
-        # now write to temporary file
-        with open(self.gd_path_file_tmp, 'w') as f:
-            json.dump(data, f, separators=(',', ':'), sort_keys=True)
-        # and copy the temporary file to our destination
-        os.rename(self.gd_path_file_tmp, self.gd_path_file)
-
-    def get_field_value(self, field, packet):
-        """Obtain the value for an output field."""
-
-        # prime our result
-        result = None
-        # get the map for this field
-        this_field_map = self.field_map.get(field)
-        # do we know about this field and do we have a source?
-        if this_field_map is not None and this_field_map.get('source') is not None:
-            # we have a source
-            source = this_field_map['source']
-            # get a few things about our result:
-            # unit group
-            result_group = this_field_map['group'] if 'group' in this_field_map else _getUnitGroup(source)
-            # result units
-            result_units = self.units_dict[result_group]
-            # do we have an aggregate
-            if this_field_map.get('aggregate') is not None and this_field_map.get('aggregate_period') is not None:
-                # We have an aggregate. Aggregates we know about are min, max,
-                # sum, last and trend.
-                agg = this_field_map['aggregate'].lower()
-                aggregate_period = this_field_map['aggregate_period'].lower()
-                # Trend requires ome special processing so pull it out first.
-                if agg == 'trend':
-                    try:
-                        trend_period = int(aggregate_period)
-                    except TypeError:
-                        trend_period = 3600
-                    grace_period = int(this_field_map.get('grace', 300))
-                    # obtain the current value as a ValueTuple
-                    _current_vt = as_value_tuple(packet, source)
-                    # calculate the trend
-                    _trend = calc_trend(obs_type=source,
-                                        now_vt=_current_vt,
-                                        target_units=result_units,
-                                        db_manager=self.db_manager,
-                                        then_ts=packet['dateTime'] - trend_period,
-                                        grace=grace_period)
-                    # if the trend result is None use the specified default
-                    if _trend is None:
-                        _trend = convert(this_field_map['default'], result_units).value
-                    result = this_field_map['format'] % _trend
-                if aggregate_period == 'day':
-                    # aggregate since start of today
-                    # is it an aggregate that has units?
-                    if agg in ('min', 'max', 'last', 'sum'):
-                        # it has units so obtain as a ValueTuple, convert as
-                        # required and check for None
-                        _raw_vt = ValueTuple(getattr(self.buffer[source], agg),
-                                             self.packet_unit_dict[source]['units'],
-                                             self.packet_unit_dict[source]['group'])
-                        # convert to the output units
-                        _conv_raw = convert(_raw_vt, result_units).value
-                        if _conv_raw is None:
-                            _conv_raw = convert(this_field_map['default'], result_units).value
-                        result = this_field_map['format'] % _conv_raw
-                    elif agg in ('mintime', 'maxtime', 'lasttime'):
-                        # its a time so get the time as a localtime and format
-                        _raw = time.localtime(getattr(self.buffer[source], agg))
-                        result = time.strftime(this_field_map['format'], _raw)
-                    else:
-                        pass
+
+    def compile_field(self, field_map, formatter):
+        """Compile a field map entry into a resolver function.
+
+        The field map does not change once we are initialised so rather than
+        interpret each field map entry for every packet we resolve everything
+        that does not depend on the packet once only and return a function
+        specialised for the field concerned.
+
+        Inputs:
+            field_map: the field map entry for the field concerned
+            formatter: the compiled format for the field concerned, refer
+                       compile_format()
+
+        Returns:
+            A function that accepts a loop packet and returns the formatted
+            field value or None.
+        """
+
+        source = field_map.get('source')
+        # if we have no source there is nothing we can do
+        if source is None:
+            return lambda packet: None
+        # get a few things about our result:
+        # unit group
+        result_group = field_map['group'] if 'group' in field_map else _getUnitGroup(source)
+        # result units
+        result_units = self.units_dict[result_group]
+        # the default in our result units
+        default = convert(field_map['default'], result_units).value
+        # and formatted, time aggregates do not use the default
+        if (field_map.get('aggregate') or '').lower() not in TIME_AGGREGATES:
+            default_str = formatter(default)
+        else:
+            default_str = None
+        # The converter from packet units to our result units depends only on
+        # the packet unit system. Packet unit details are cached per unit
+        # system so remember the converter along with the packet unit details
+        # it was obtained from and only obtain it again if they change.
+        cached_converter = [(None, None)]
+
+        def packet_converter():
+            _unit_dict, _convert = cached_converter[0]
+            if _unit_dict is not self.packet_unit_dict:
+                _unit_dict = self.packet_unit_dict
+                _convert = get_converter(_unit_dict[source]['units'], result_units)
+                cached_converter[0] = (_unit_dict, _convert)
+            return _convert
+
+        agg = field_map.get('aggregate')
+        aggregate_period = field_map.get('aggregate_period')
+        if agg is None or aggregate_period is None:
+            # no aggregate so get the value from the packet and convert to
+            # the output units
+            def resolve(packet):
+                if source in packet:
+                    _convert = packet_converter()
+                    _conv_raw = _convert(packet[source])
                 else:
-                    # afraid we don't know what to do
-                    pass
+                    _conv_raw = None
+                return formatter(_conv_raw) if _conv_raw is not None else default_str
+            return resolve
+        # We have an aggregate. Aggregates we know about are min, max, sum,
+        # last and trend.
+        agg = agg.lower()
+        # Trend requires some special processing so pull it out first.
+        if agg == 'trend':
+            # a trend needs a period in seconds, if we don't have one use an
+            # hour
+            if isinstance(aggregate_period, int):
+                trend_period = aggregate_period
             else:
-                # no aggregate so get the value from the packet as a ValueTuple
-                if source in packet:
-                    _raw_vt = as_value_tuple(packet, source)
+                trend_period = 3600
+            grace_period = field_map.get('grace_period', 300)
+            # we need this source whenever we obtain a trend record
+            self.trend_sources.add(source)
+
+            # Loop samples (timestamp, value in result units) of our source
+            # covering the trend period. The start of trend value is taken
+            # from these samples when they cover the start of the trend
+            # period, otherwise we fall back to the archive.
+            samples = SampleWindow()
+
+            def resolve(packet):
+                ts = packet['dateTime']
+                then_ts = ts - trend_period
+                _now = packet.get(source)
+                if _now is not None:
+                    _convert = packet_converter()
+                    _now = _convert(_now)
+                    samples.append(ts, _now)
+                # discard any samples that can no longer be the closest sample
+                # to the start of the trend period
+                while len(samples) > 1 and samples[1][0] <= then_ts:
+                    samples.popleft()
+                # find the sample closest to the start of the trend period
+                # that is within the grace period
+                _then = None
+                for _i in range(min(len(samples), 2)):
+                    _sample = samples[_i]
+                    if abs(_sample[0] - then_ts) <= grace_period and \
+                            (_then is None or abs(_sample[0] - then_ts) < abs(_then[0] - then_ts)):
+                        _then = _sample
+                if _then is not None:
+                    # calculate the trend from our samples
+                    _trend = _now - _then[1] if _now is not None else None
                 else:
-                    _raw_vt = ValueTuple(None, result_units, _getUnitGroup(source))
-                # convert to the output units
-                _conv_raw = convert(_raw_vt, result_units).value
-                if _conv_raw is None:
-                    _conv_raw = convert(this_field_map['default'], result_units).value
-                result = this_field_map['format'] % _conv_raw
-        return result
+                    # calculate the trend using the archive
+                    _then_record = self.get_trend_record(then_ts, grace_period)
+                    _trend = calc_trend(obs_type=source,
+                                        now_vt=as_value_tuple(packet, source),
+                                        target_units=result_units,
+                                        then_record=_then_record)
+                # if the trend result is None use the default
+                return formatter(_trend) if _trend is not None else default_str
+            return resolve
+        if aggregate_period == 'day':
+            # aggregate since start of today
+            # is it an aggregate that has units?
+            # the aggregate is a fixed attribute of the buffer for our source,
+            # so obtain a getter for it once only
+            get_agg = attrgetter(agg)
+            # the buffer object is shared with RealtimeData for the life of
+            # the thread, only the per-source buffers it holds come and go
+            buffer = self.buffer
+            if agg in ('min', 'max', 'last', 'sum'):
+                # it has units so convert to the output units as required and
+                # check for None
+                def resolve(packet):
+                    _convert = packet_converter()
+                    _conv_raw = _convert(get_agg(buffer[source]))
+                    return formatter(_conv_raw) if _conv_raw is not None else default_str
+                return resolve
+            elif agg in TIME_AGGREGATES:
+                # its a time so format it as a localtime
+                def resolve(packet):
+                    return formatter(get_agg(buffer[source]))
+                return resolve
+        # afraid we don't know what to do
+        return lambda packet: None
+
+    def get_trend_record(self, then_ts, grace):
+        """Obtain the archive record used as the start of a trend.
+
+        Trend fields that share the same trend period and grace share the
+        same archive record. The record is obtained from the database once
+        only per packet irrespective of the number of trend fields using it.
+        The record returned contains only those fields used by trend fields.
+
+        Inputs:
+            then_ts: timestamp of start of trend period
+            grace:   the largest difference in time when finding the then_ts
+                     record that is acceptable
+
+        Returns:
+            The archive record or None if no record could be found.
+        """
+
+        try:
+            return self.trend_records[(then_ts, grace)]
+        except KeyError:
+            pass
+        _row = self.db_manager.getSql(self.trend_sql,
+                                      (then_ts - grace, then_ts + grace, then_ts))
+        _rec = dict(zip(self.trend_columns, _row)) if _row else None
+        self.trend_records[(then_ts, grace)] = _rec
+        return _rec
 
     def get_packet_units(self, packet):
-        """Given a packet obtain unit details for each field map source."""
+        """Given a packet obtain unit details for each field map source.
+
+        The unit details depend only on the packet unit system so they are
+        calculated once only for each unit system seen.
+        """
 
-        packet_unit_dict = {}
         packet_unit_system = packet['usUnits']
-        for field, field_map in self.field_map.items():
-            source = field_map['source']
-            if source not in packet_unit_dict:
-                (units, unit_group) = getStandardUnitType(packet_unit_system,
-                                                          source)
-                packet_unit_dict[source] = {'units': units,
-                                            'group': unit_group}
-        # add in units and group details for fields windSpeed and rain to
-        # facilitate non-field map based field calculations
-        for source in ('windSpeed', 'rain'):
-            if source not in packet_unit_dict:
-                (units, unit_group) = getStandardUnitType(packet_unit_system,
-                                                          source)
-                packet_unit_dict[source] = {'units': units,
-                                            'group': unit_group}
+        try:
+            return self.unit_system_units[packet_unit_system]
+        except KeyError:
+            pass
+        packet_unit_dict = {}
+        for source in self.unit_sources:
+            (units, unit_group) = getStandardUnitType(packet_unit_system,
+                                                      source)
+            packet_unit_dict[source] = {'units': units,
+                                        'group': unit_group}
+        self.unit_system_units[packet_unit_system] = packet_unit_dict
         return packet_unit_dict
 
     def calculate(self, packet):
@@ -1369,11 +1728,13 @@ class GaugeDataThread(user.rtd.RealtimeDataThread):
         ts = packet['dateTime']
         # obtain a dict of units and unit group for each source in the field map
         self.packet_unit_dict = self.get_packet_units(packet)
+        # any trend records obtained for the previous packet are now stale
+        self.trend_records = {}
         # construct a dict to hold our results
         data = dict()
 
         # obtain 10 minute average wind direction
-        avg_bearing_10 = self.buffer['wind'].history_vec_avg.dir
+        avg_bearing_10 = self.buffer['wind'].history_vec_dir
 
         # First we populate all non-field map calculated fields and then
         # iterate over the field map populating the field map based fields.
@@ -1381,47 +1742,49 @@ class GaugeDataThread(user.rtd.RealtimeDataThread):
         # content of a non-field map based field (eg 'rose').
 
         # timeUTC - UTC date/time in format YYYY,mm,dd,HH,MM,SS
-        data['timeUTC'] = datetime.datetime.utcfromtimestamp(ts).strftime("%Y,%m,%d,%H,%M,%S")
         # date - date in (default) format Y.m.d HH:MM
-        data['date'] = time.strftime(self.date_format, time.localtime(ts))
-        # dateFormat - date format
-        data['dateFormat'] = self.date_format.replace('%', '')
+        # Both only change when the timestamp changes so reuse the last
+        # results if the timestamp is unchanged.
+        if ts != self.time_strings[0]:
+            self.time_strings = (ts,
+                                 time.strftime("%Y,%m,%d,%H,%M,%S", time.gmtime(ts)),
+                                 time.strftime(self.date_format, time.localtime(ts)))
+        data['timeUTC'] = self.time_strings[1]
+        data['date'] = self.time_strings[2]
+        # dateFormat, the units fields and the version fields do not change so
+        # add them in one go
+        data.update(self.const_data)
         # SensorContactLost - 1 if the station has lost contact with its remote
         # sensors "Fine Offset only" 0 if contact has been established
-        data['SensorContactLost'] = self.flag_format % self.lost_contact_flag
-        # tempunit - temperature units - C, F
-        data['tempunit'] = UNITS_TEMP[self.temp_group]
-        # windunit -wind units - m/s, mph, km/h, kts
-        data['windunit'] = UNITS_WIND[self.wind_group]
-        # pressunit - pressure units - mb, hPa, in
-        data['pressunit'] = UNITS_PRES[self.pres_group]
-        # rainunit - rain units - mm, in
-        data['rainunit'] = UNITS_RAIN[self.rain_group]
-        # cloudbaseunit - cloud base units - m, ft
-        data['cloudbaseunit'] = UNITS_CLOUD[self.alt_group]
+        data['SensorContactLost'] = self.flag_formatter(self.lost_contact_flag)
 
         # TODO. pressL and pressH need to be refactored to use a field map
-        # pressL - all time low barometer
-        if self.min_barometer is not None:
-            press_l_vt = ValueTuple(self.min_barometer,
-                                    self.packet_unit_dict['barometer']['units'],
-                                    self.packet_unit_dict['barometer']['group'])
-        else:
-            press_l_vt = ValueTuple(850, 'hPa', self.packet_unit_dict['barometer']['group'])
-        press_l = convert(press_l_vt, self.pres_group).value
-        data['pressL'] = self.pres_format % press_l
-        # pressH - all time high barometer
-        if self.max_barometer is not None:
-            press_h_vt = ValueTuple(self.max_barometer,
-                                    self.packet_unit_dict['barometer']['units'],
-                                    self.packet_unit_dict['barometer']['group'])
-        else:
-            press_h_vt = ValueTuple(1100, 'hPa', self.packet_unit_dict['barometer']['group'])
-        press_h = convert(press_h_vt, self.pres_group).value
-        data['pressH'] = self.pres_format % press_h
+        # pressL and pressH only change when we receive new stats or the
+        # packet barometer units change so only format them when that happens
+        _press_key = (self.packet_unit_dict['barometer']['units'],
+                      self.min_barometer,
+                      self.max_barometer)
+        if _press_key != self.press_strings[0]:
+            _convert = get_converter(_press_key[0], self.pres_group)
+            # pressL - all time low barometer
+            if self.min_barometer is not None:
+                press_l = _convert(self.min_barometer)
+            else:
+                press_l = get_converter('hPa', self.pres_group)(850)
+            # pressH - all time high barometer
+            if self.max_barometer is not None:
+                press_h = _convert(self.max_barometer)
+            else:
+                press_h = get_converter('hPa', self.pres_group)(1100)
+            self.press_strings = (_press_key,
+                                  self.pres_formatter(press_l),
+                                  self.pres_formatter(press_h))
+        data['pressL'] = self.press_strings[1]
+        data['pressH'] = self.press_strings[2]
 
         # domwinddir - Today's dominant wind direction as compass point
-        dom_dir = self.buffer['wind'].day_vec_avg.dir
+        # only the direction is needed so don't calculate the magnitude
+        dom_dir = self.buffer['wind'].day_vec_dir
         data['domwinddir'] = degree_to_compass(dom_dir)
 
         # WindRoseData -
@@ -1435,43 +1798,49 @@ class GaugeDataThread(user.rtd.RealtimeDataThread):
         # FIXME. Need to determine ThourlyrainTH
         data['ThourlyrainTH'] = "00:00"
 
-        # LastRainTipISO - date and time of last rainfall
-        if self.last_rain_ts is not None:
-            _last_rain_tip_iso = time.strftime(self.date_format,
-                                               time.localtime(self.last_rain_ts))
-        else:
-            _last_rain_tip_iso = "1/1/1900 00:00"
-        data['LastRainTipISO'] = _last_rain_tip_iso
+        # LastRainTipISO - date and time of last rainfall, the buffer sees
+        # every loop packet so it holds the time of any rain tip since we
+        # started, otherwise we use the time of last rain from the database
+        _last_rain_ts = self.buffer.last_rain_ts
+        if _last_rain_ts is not None:
+            self.last_rain_ts = _last_rain_ts
+        # rain tips are rare so only format the time of last rain if it has
+        # changed
+        if self.last_rain_ts != self.last_rain_tip[0]:
+            if self.last_rain_ts is not None:
+                _last_rain_tip_iso = time.strftime(self.date_format,
+                                                   time.localtime(self.last_rain_ts))
+            else:
+                _last_rain_tip_iso = "1/1/1900 00:00"
+            self.last_rain_tip = (self.last_rain_ts, _last_rain_tip_iso)
+        data['LastRainTipISO'] = self.last_rain_tip[1]
 
         # wspeed - wind speed (average)
         # obtain the average wind speed from the buffer
         _wspeed = self.buffer['windSpeed'].history_avg(ts=ts, age=600)
-        # put into a ValueTuple so we can convert
-        wspeed_vt = ValueTuple(_wspeed,
-                               self.packet_unit_dict['windSpeed']['units'],
-                               self.packet_unit_dict['windSpeed']['group'])
         # convert to output units
-        wspeed = convert(wspeed_vt, self.wind_group).value
+        _convert_wind = get_converter(self.packet_unit_dict['windSpeed']['units'],
+                                      self.wind_group)
+        wspeed = _convert_wind(_wspeed)
         # handle None values
         wspeed = wspeed if wspeed is not None else 0.0
-        data['wspeed'] = self.wind_format % wspeed
+        data['wspeed'] = self.wind_formatter(wspeed)
 
         # wgust - 10 minute high gust
         # first look for max windGust value in the history, if windGust is not
         # in the buffer then use windSpeed, if no windSpeed then use 0.0
-        if 'windGust' in self.buffer:
-            wgust = self.buffer['windGust'].history_max(ts, age=600).value
-        elif 'windSpeed' in self.buffer:
-            wgust = self.buffer['windSpeed'].history_max(ts, age=600).value
+        gust_buffer = self.buffer.get('windGust')
+        if gust_buffer is None:
+            gust_buffer = self.buffer.get('windSpeed')
+        if gust_buffer is not None:
+            _max = gust_buffer.history_max(ts, age=600)
         else:
-            wgust = 0.0
-        # put into a ValueTuple so we can convert
-        wgust_vt = ValueTuple(wgust,
-                              self.packet_unit_dict['windSpeed']['units'],
-                              self.packet_unit_dict['windSpeed']['group'])
+            _max = None
+        # history_max() returns None if there are no samples in the period
+        wgust = _max.value if _max is not None else 0.0
         # convert to output units
-        wgust = convert(wgust_vt, self.wind_group).value
-        data['wgust'] = self.wind_format % wgust
+        wgust = _convert_wind(wgust)
+        data['wgust'] = self.wind_formatter(wgust)
 
         # bearing - wind bearing (degrees)
         bearing = packet['windDir']
@@ -1480,10 +1849,10 @@ class GaugeDataThread(user.rtd.RealtimeDataThread):
         # our wind dir needle will always how the last non-None windDir rather
         # than return to 0
         self.last_dir = bearing
-        data['bearing'] = self.dir_format % bearing
+        data['bearing'] = self.dir_formatter(bearing)
 
         # avgbearing - 10-minute average wind bearing (degrees)
-        data['avgbearing'] = self.dir_format % avg_bearing_10 if avg_bearing_10 is not None else self.dir_format % 0.0
+        data['avgbearing'] = self.dir_formatter(avg_bearing_10) if avg_bearing_10 is not None else self.dir_formatter(0.0)
 
         # BearingRangeFrom10 - The 'lowest' bearing in the last 10 minutes
         # BearingRangeTo10 - The 'highest' bearing in the last 10 minutes
@@ -1494,81 +1863,85 @@ class GaugeDataThread(user.rtd.RealtimeDataThread):
             # 10 minutes, but we want the direction to be in -180 to
             # 180 degrees range rather than from 0 to 360 degrees. Also the
             # values must be relative to the 10 minute average wind direction.
-            # Wrap in a try.except just in case.
+            # Taking the offset modulo 360 maps it to the -180 to 180 degree
+            # range in a single step. The constant part of the offset is
+            # calculated once and the final - 180 is applied to the min and
+            # max only rather than to every direction. Wrap in a try.except
+            # just in case.
             try:
-                _offset_dir = [self.to_plusminus(obs.value.dir-avg_bearing_10) for obs in self.buffer['wind'].history]
+                _shift = 180.0 - avg_bearing_10
+                _offset_dir = [(_dir + _shift) % 360.0
+                               for _dir in self.buffer['wind'].history_dir]
+                # Now find the min and max values and transpose back to the 0
+                # to 360 degrees range relative to North (0 degrees).
+                bearing_range_from_10 = (min(_offset_dir) - _shift) % 360.0
+                bearing_range_to_10 = (max(_offset_dir) - _shift) % 360.0
             except (TypeError, ValueError):
-                # if we strike an error then return 0 for both results
-                bearing_range_from_10 = 0
-                bearing_range_to_10 = 0
-            # Now find the min and max values and transpose back to the 0 to
-            # 360 degrees range relative to North (0 degrees). Wrap in a
-            # try..except just in case.
-            try:
-                bearing_range_from_10 = self.to_threesixty(min(_offset_dir) + avg_bearing_10)
-                bearing_range_to_10 = self.to_threesixty(max(_offset_dir) + avg_bearing_10)
-            except TypeError:
-                # if we strike an error then return 0 for both results
+                # if we strike an error, or have no history, then return 0 for
+                # both results
                 bearing_range_from_10 = 0
                 bearing_range_to_10 = 0
         else:
             bearing_range_from_10 = 0
             bearing_range_to_10 = 0
         # store the formatted results
-        data['BearingRangeFrom10'] = self.dir_format % bearing_range_from_10
-        data['BearingRangeTo10'] = self.dir_format % bearing_range_to_10
+        data['BearingRangeFrom10'] = self.dir_formatter(bearing_range_from_10)
+        data['BearingRangeTo10'] = self.dir_formatter(bearing_range_to_10)
 
         # forecast - forecast text
         _text = self.scroller_text if self.scroller_text is not None else ''
-        # format the forecast string, we might get a UnicodeDecode error, be
-        # prepared to catch it
-        try:
-            data['forecast'] = time.strftime(_text, time.localtime(ts))
-        except UnicodeEncodeError:
-            # FIXME. Possible unicode/bytes issue
-            data['forecast'] = time.strftime(_text.encode('ascii', 'ignore'), time.localtime(ts))
-        # version - weather software version
-        data['version'] = '%s' % weewx.__version__
-        # build -
-        data['build'] = ''
-        # ver - gauge-data.txt version number
-        data['ver'] = self.version
+        if '%' not in _text:
+            # the forecast text contains no format directives so there is
+            # nothing to format
+            data['forecast'] = _text
+        else:
+            # format the forecast string, we might get a UnicodeDecode error,
+            # be prepared to catch it
+            try:
+                data['forecast'] = time.strftime(_text, time.localtime(ts))
+            except UnicodeEncodeError:
+                # FIXME. Possible unicode/bytes issue
+                data['forecast'] = time.strftime(_text.encode('ascii', 'ignore'), time.localtime(ts))
+        # refresh our month and/or year to date rain for completed days if
+        # this is the first packet of a new day, the bounds of the current day
+        # are known so there is no need to find the start of day for every
+        # packet
+        if self.mtd_rain or self.ytd_rain:
+            if self.rain_day_start is None or not self.rain_day_start <= ts < self.rain_day_end:
+                self.get_completed_days_rain(weeutil.weeutil.startOfDay(ts))
+            # today's rain from the buffer in the output units, this is common
+            # to month and year to date rain
+            # TODO. Check this, particularly usage of buffer['rain'].sum
+            rain_b = get_converter(self.packet_unit_dict['rain']['units'],
+                                   self.rain_group)(self.buffer['rain'].sum)
         # month to date rain, only calculate if we have been asked
-        # TODO. Check this, particularly usage of buffer['rain'].sum
         if self.mtd_rain:
             if self.month_rain is not None:
-                rain_m = convert(self.month_rain, self.rain_group).value
-                rain_b_vt = ValueTuple(self.buffer['rain'].sum,
-                                       self.packet_unit_dict['rain']['units'],
-                                       self.packet_unit_dict['rain']['group'])
-                rain_b = convert(rain_b_vt, self.rain_group).value
+                rain_m = get_converter(self.month_rain.unit, self.rain_group)(self.month_rain.value)
                 if rain_m is not None and rain_b is not None:
                     rain_m = rain_m + rain_b
                 else:
                     rain_m = 0.0
             else:
                 rain_m = 0.0
-            data['mrfall'] = self.rain_format % rain_m
+            data['mrfall'] = self.rain_formatter(rain_m)
         # year to date rain, only calculate if we have been asked
-        # TODO. Check this, particularly usage of buffer['rain'].sum
         if self.ytd_rain:
             if self.year_rain is not None:
-                rain_y = convert(self.year_rain, self.rain_group).value
-                rain_b_vt = ValueTuple(self.buffer['rain'].sum,
-                                       self.packet_unit_dict['rain']['units'],
-                                       self.packet_unit_dict['rain']['group'])
-                rain_b = convert(rain_b_vt, self.rain_group).value
+                rain_y = get_converter(self.year_rain.unit, self.rain_group)(self.year_rain.value)
                 if rain_y is not None and rain_b is not None:
                     rain_y = rain_y + rain_b
                 else:
                     rain_y = 0.0
             else:
                 rain_y = 0.0
-            data['yrfall'] = self.rain_format % rain_y
+            data['yrfall'] = self.rain_formatter(rain_y)
 
-        # now populate all fields in the field map
-        for field in self.field_map:
-            data[field] = self.get_field_value(field, packet)
+        # now populate all fields in the field map, those without a source
+        # first
+        data.update(self.null_fields)
+        for field, resolve in self.field_resolvers:
+            data[field] = resolve(packet)
         return data
 
     def process_new_archive_record(self, record):
@@ -1581,6 +1954,118 @@ class GaugeDataThread(user.rtd.RealtimeDataThread):
             self.windSpeedAvg_vt = weewx.units.as_value_tuple(record, 'windSpeed')
         else:
             self.windSpeedAvg_vt = ValueTuple(None, 'km_per_hour', 'group_speed')
+        # once an archive record from the current day has been saved the
+        # previous day is complete, so correct our month and/or year to date
+        # rain for any rain the previous day gained after we last read it
+        if self.rain_prev_day is not None and record['dateTime'] >= self.rain_day_start:
+            self.correct_prev_day_rain()
+
+    def get_completed_days_rain(self, day_start):
+        """Obtain month and year to date rain for completed days.
+
+        The rain totals for the completed days of the current month and year
+        are obtained from the rain daily summary. The totals do not change
+        until the day rolls over so the totals are cached and are only
+        refreshed on the first packet of each day. Today's rain is added
+        separately from our buffer.
+
+        If the totals were last refreshed yesterday the totals are updated
+        incrementally by adding yesterday's rain (or restarted at the start of
+        a new month or year) rather than summing the daily summary for the
+        whole month or year again. Either way the archive record that
+        completes yesterday may not have been saved yet, so the rain included
+        for yesterday is corrected by correct_prev_day_rain() once that record
+        arrives.
+
+        Input:
+            day_start: timestamp of the start of the current day
+        """
+
+        _tt = time.localtime(day_start)
+        # the units used in the database, an empty database has no unit
+        # system but then there is no rain either so any unit system will do
+        _unit_system = self.db_manager.std_unit_system
+        if _unit_system is None:
+            _unit_system = weewx.METRIC
+        _units, _group = getStandardUnitType(_unit_system, 'rain')
+        _prev_day_start = self.rain_day_start
+        if _prev_day_start is not None and \
+                weeutil.weeutil.startOfDay(day_start - 1) == _prev_day_start:
+            # we have totals as of the start of yesterday, so just add
+            # yesterday's rain
+            _sql = "SELECT sum FROM %s_day_rain WHERE dateTime = ?" % self.db_manager.table_name
+            _row = self.db_manager.getSql(_sql, (_prev_day_start,))
+            _day_rain = _row[0] if _row and _row[0] is not None else 0.0
+            self.rain_prev_day = (_prev_day_start, _day_rain)
+            _prev_tt = time.localtime(_prev_day_start)
+            if self.mtd_rain:
+                if _prev_tt.tm_mon == _tt.tm_mon and self.month_rain.value is not None:
+                    _rain = self.month_rain.value + _day_rain
+                else:
+                    _rain = 0.0
+                self.month_rain = ValueTuple(_rain, _units, _group)
+            if self.ytd_rain:
+                if _prev_tt.tm_year == _tt.tm_year and self.year_rain.value is not None:
+                    _rain = self.year_rain.value + _day_rain
+                else:
+                    _rain = 0.0
+                self.year_rain = ValueTuple(_rain, _units, _group)
+        else:
+            # we need to sum the daily summary for the month and/or year
+            _sql = "SELECT SUM(sum) FROM %s_day_rain " \
+                   "WHERE dateTime >= ? AND dateTime < ?" % self.db_manager.table_name
+            if self.mtd_rain:
+                _month_start = int(time.mktime((_tt.tm_year, _tt.tm_mon, 1,
+                                                0, 0, 0, 0, 0, -1)))
+                _row = self.db_manager.getSql(_sql, (_month_start, day_start))
+                _rain = _row[0] if _row and _row[0] is not None else 0.0
+                self.month_rain = ValueTuple(_rain, _units, _group)
+            if self.ytd_rain:
+                _year_start = int(time.mktime((_tt.tm_year, 1, 1,
+                                               0, 0, 0, 0, 0, -1)))
+                _row = self.db_manager.getSql(_sql, (_year_start, day_start))
+                _rain = _row[0] if _row and _row[0] is not None else 0.0
+                self.year_rain = ValueTuple(_rain, _units, _group)
+            # the sums include yesterday's rain, which may yet be missing its
+            # final archive interval, so note it for correct_prev_day_rain()
+            _prev_day_start = weeutil.weeutil.startOfDay(day_start - 1)
+            _sql = "SELECT sum FROM %s_day_rain WHERE dateTime = ?" % self.db_manager.table_name
+            _row = self.db_manager.getSql(_sql, (_prev_day_start,))
+            _day_rain = _row[0] if _row and _row[0] is not None else 0.0
+            self.rain_prev_day = (_prev_day_start, _day_rain)
+        self.rain_day_start = day_start
+        # the end of the day, allowing for days that are not 24 hours long
+        self.rain_day_end = weeutil.weeutil.startOfDay(day_start + 90000)
+
+    def correct_prev_day_rain(self):
+        """Correct month and year to date rain for yesterday's final rain.
+
+        When the completed day rain totals were refreshed the archive record
+        that completes yesterday may not have been saved, in which case the
+        totals are missing any rain in yesterday's final archive interval.
+        Read yesterday's rain from the rain daily summary again and add any
+        difference to the totals.
+        """
+
+        _prev_day_start, _day_rain = self.rain_prev_day
+        self.rain_prev_day = None
+        _sql = "SELECT sum FROM %s_day_rain WHERE dateTime = ?" % self.db_manager.table_name
+        _row = self.db_manager.getSql(_sql, (_prev_day_start,))
+        _delta = (_row[0] if _row and _row[0] is not None else 0.0) - _day_rain
+        if _delta == 0.0:
+            return
+        # yesterday only counts towards the totals if it is in the current
+        # month or year
+        _tt = time.localtime(self.rain_day_start)
+        _prev_tt = time.localtime(_prev_day_start)
+        if self.mtd_rain and _prev_tt.tm_mon == _tt.tm_mon and self.month_rain.value is not None:
+            self.month_rain = ValueTuple(self.month_rain.value + _delta,
+                                         self.month_rain.unit,
+                                         self.month_rain.group)
+        if self.ytd_rain and _prev_tt.tm_year == _tt.tm_year and self.year_rain.value is not None:
+            self.year_rain = ValueTuple(self.year_rain.value + _delta,
+                                        self.year_rain.unit,
+                                        self.year_rain.group)
 
     def calc_last_rain_stamp(self):
         """Calculate the timestamp of the last rain.
@@ -1590,8 +2075,14 @@ class GaugeDataThread(user.rtd.RealtimeDataThread):
         search that day for the actual timestamp.
         """
 
-        _row = self.db_manager.getSql("SELECT MAX(dateTime) FROM archive_day_rain WHERE sum > 0")
-        last_rain_ts = _row[0]
+        # Both tables are keyed on dateTime so searching back from the most
+        # recent row and stopping at the first row with rain uses the primary
+        # key index and only visits the rows since the last rain. SQLite does
+        # this for MAX() with a WHERE clause but MySQL visits every row.
+        _table = self.db_manager.table_name
+        _row = self.db_manager.getSql("SELECT dateTime FROM %s_day_rain WHERE sum > 0 "
+                                      "ORDER BY dateTime DESC LIMIT 1" % _table)
+        last_rain_ts = _row[0] if _row is not None else None
         # now limit our search on the archive to the day concerned, wrap in a
         # try statement just in case
         if last_rain_ts is not None:
@@ -1602,8 +2093,9 @@ class GaugeDataThread(user.rtd.RealtimeDataThread):
             # TimeSpan for the archive day containing that ts.
             last_rain_tspan = weeutil.weeutil.archiveDaySpan(last_rain_ts+1)
             try:
-                _row = self.db_manager.getSql("SELECT MAX(dateTime) FROM archive "
-                                              "WHERE rain > 0 AND dateTime > ? AND dateTime <= ?",
+                _row = self.db_manager.getSql("SELECT dateTime FROM %s "
+                                              "WHERE dateTime > ? AND dateTime <= ? AND rain > 0 "
+                                              "ORDER BY dateTime DESC LIMIT 1" % _table,
                                               last_rain_tspan)
                 last_rain_ts = _row[0]
             except (IndexError, TypeError):
@@ -1613,37 +2105,94 @@ class GaugeDataThread(user.rtd.RealtimeDataThread):
     def get_lost_contact(self, rec, packet_type):
         """Determine is station has lost contact with sensors."""
 
-        # default to lost contact = False
-        result = False
-        # if we are not ignoring the lost contact test do the check
-        if not self.ignore_lost_contact:
-            if ((packet_type == 'loop' and self.station_type in LOOP_STATIONS) or
-                    (packet_type == 'archive' and self.station_type in ARCHIVE_STATIONS)):
-                _v = STATION_LOST_CONTACT[self.station_type]['value']
-                try:
-                    result = rec[STATION_LOST_CONTACT[self.station_type]['field']] == _v
-                except KeyError:
-                    log.debug("KeyError: Could not determine sensor contact state")
-                    result = True
-        return result
-
-    @staticmethod
-    def to_plusminus(val):
-        """Map a 0 to 360 degree direction to -180 to +180 degrees."""
-
-        if val is not None and val > 180:
-            return val - 360
-        else:
-            return val
+        return self.lost_contact_checks[packet_type](rec)
 
-    @staticmethod
-    def to_threesixty(val):
-        """Map a -180 to +180 degrees direction to 0 to 360 degrees."""
+    def compile_lost_contact(self, packet_type):
+        """Obtain a function to determine if a station has lost contact.
 
-        if val is not None and val < 0:
-            return val + 360
-        else:
-            return val
+        Inputs:
+            packet_type: the type of packet to be checked, 'loop' or 'archive'
+
+        Returns:
+            A function that accepts a packet or record of type packet_type and
+            returns True if the station has lost contact with its sensors,
+            otherwise False.
+        """
+
+        # if we are ignoring the lost contact test or our station type does
+        # not report lost contact in this type of packet there is no check to
+        # do, lost contact is always False
+        if self.ignore_lost_contact:
+            return lambda rec: False
+        if not ((packet_type == 'loop' and self.station_type in LOOP_STATIONS) or
+                (packet_type == 'archive' and self.station_type in ARCHIVE_STATIONS)):
+            return lambda rec: False
+        field = self.lost_contact_field
+        value = self.lost_contact_value
+
+        def check(rec):
+            try:
+                return rec[field] == value
+            except KeyError:
+                log.debug("KeyError: Could not determine sensor contact state")
+                return True
+        return check
+
+
+# ============================================================================
+#                            class SampleWindow
+# ============================================================================
+
+class SampleWindow(object):
+    """A time ordered window of (timestamp, value) samples.
+
+    Samples are appended on the right and discarded from the left. Timestamps
+    and values are held in a pair of array.array ring buffers rather than as a
+    container of tuples, the ring buffers are enlarged if they fill.
+    """
+
+    def __init__(self, size=64):
+        self.ts = array.array('d', [0.0]) * size
+        self.values = array.array('d', [0.0]) * size
+        # index of the oldest sample
+        self.head = 0
+        # the number of samples held
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        """Return the index'th oldest sample as a tuple (timestamp, value)."""
+
+        if not 0 <= index < self.count:
+            raise IndexError("sample index out of range")
+        _i = (self.head + index) % len(self.ts)
+        return self.ts[_i], self.values[_i]
+
+    def append(self, ts, value):
+        """Add a sample, the sample must be no older than any held sample."""
+
+        size = len(self.ts)
+        if self.count == size:
+            # we are full, so unroll the ring buffers oldest first and double
+            # their size
+            self.ts = self.ts[self.head:] + self.ts[:self.head] + array.array('d', [0.0]) * size
+            self.values = self.values[self.head:] + self.values[:self.head] + array.array('d', [0.0]) * size
+            self.head = 0
+            size *= 2
+        _i = (self.head + self.count) % size
+        self.ts[_i] = ts
+        self.values[_i] = value
+        self.count += 1
+
+    def popleft(self):
+        """Discard the oldest sample."""
+
+        if self.count == 0:
+            raise IndexError("pop from an empty sample window")
+        self.head = (self.head + 1) % len(self.ts)
+        self.count -= 1
 
 
 # ============================================================================
@@ -1663,21 +2212,150 @@ def degree_to_compass(x):
 
     if x is None:
         return None
-    idx = int((x + 11.25) / 22.5)
-    return COMPASS_POINTS[idx]
+    # masking with 15 wraps directions of 348.75 degrees and above back to N
+    return COMPASS_POINTS[int((x + 11.25) / 22.5) & 15]
+
+
+def compile_format(fmt, aggregate=None):
+    """Compile a field map format string into a formatting callable.
+
+    Inputs:
+        fmt:       the field map format string, eg '%.1f' or '%H:%M'
+        aggregate: the field map aggregate, if any
+
+    Returns:
+        A callable that accepts a single value and returns the formatted
+        string. Time aggregates accept an epoch timestamp that is formatted as
+        a local time.
+    """
+
+    if aggregate is not None and aggregate.lower() in TIME_AGGREGATES:
+        # The time of an aggregate (eg the time of today's max) seldom changes
+        # between packets, so remember the last timestamp formatted and its
+        # result. Both are held in a single tuple so they are always updated
+        # together.
+        last = [(object(), None)]
+        # The usual time format is HH:MM, which can be formatted directly from
+        # the timestamp and the local UTC offset without the overhead of
+        # strftime(). The UTC offset can only change on a quarter hour
+        # boundary so the offset is obtained once per quarter hour.
+        if fmt == '%H:%M':
+            offset = [(None, None)]
+
+            def _format(ts):
+                if ts is None:
+                    return '%02d:%02d' % time.localtime()[3:5]
+                _ts = int(ts)
+                _quarter, _offset = offset[0]
+                if _ts // 900 != _quarter:
+                    _quarter = _ts // 900
+                    _offset = time.localtime(_quarter * 900).tm_gmtoff
+                    offset[0] = (_quarter, _offset)
+                _local = _ts + _offset
+                return '%02d:%02d' % ((_local // 3600) % 24, (_local // 60) % 60)
+        else:
+            def _format(ts):
+                return time.strftime(fmt, time.localtime(ts))
+
+        def format_time(ts):
+            # a timestamp of None is formatted as the current time so its
+            # result cannot be remembered
+            if ts is None:
+                return _format(ts)
+            _last_ts, _last_result = last[0]
+            if ts == _last_ts:
+                return _last_result
+            _result = _format(ts)
+            last[0] = (ts, _result)
+            return _result
+        return format_time
+    return fmt.__mod__
+
+
+def get_converter(from_units, to_units):
+    """Obtain a function to convert a scalar value between two units.
+
+    Converting via weewx.units.convert() requires a ValueTuple be constructed
+    and the conversion function be looked up on every call. Instead look up
+    the conversion function once for each pair of units and save it for
+    reuse.
+
+    Inputs:
+        from_units: the units of the values to be converted
+        to_units:   the units to convert to
 
+    Returns:
+        A function that accepts a value in from_units and returns the value in
+        to_units. None values are returned unchanged.
+    """
 
-def calc_trend(obs_type, now_vt, target_units, db_manager, then_ts, grace=0):
+    try:
+        return CONVERTERS[(from_units, to_units)]
+    except KeyError:
+        pass
+    if to_units is None or from_units == to_units:
+        def _convert(value):
+            return value
+    else:
+        try:
+            func = weewx.units.conversionDict[from_units][to_units]
+        except KeyError:
+            # we have no direct conversion so fall back to convert() which
+            # will deal with (and log) any problems
+            def _convert(value):
+                return convert(ValueTuple(value, from_units, None), to_units).value
+        else:
+            scale, offset = linear_factors(func)
+            if scale is not None:
+                # the conversion is linear so it is a multiply and an add
+                # rather than a call through the conversion function
+                def _convert(value):
+                    return value * scale + offset if value is not None else None
+            else:
+                def _convert(value):
+                    return func(value) if value is not None else None
+    CONVERTERS[(from_units, to_units)] = _convert
+    return _convert
+
+
+def linear_factors(func):
+    """Obtain the scale and offset of a linear unit conversion function.
+
+    Most unit conversions are of the form y = scale * x + offset. The scale
+    and offset are obtained by probing the conversion function, the function
+    is then checked against the scale and offset at some other values to
+    confirm it is linear.
+
+    Inputs:
+        func: a function that converts a scalar value between two units
+
+    Returns:
+        A two way tuple (scale, offset). Both elements are None if the
+        function is not linear.
+    """
+
+    try:
+        offset = float(func(0.0))
+        # probe well away from 0 to limit the rounding error in the scale
+        scale = (float(func(1000000.0)) - offset) / 1000000.0
+        for x in (-40.0, 10.0, 1013.25):
+            y = float(func(x))
+            if abs(y - (x * scale + offset)) > 1e-9 * max(1.0, abs(y)):
+                return None, None
+    except (ArithmeticError, TypeError, ValueError):
+        return None, None
+    return scale, offset
+
+
+def calc_trend(obs_type, now_vt, target_units, then_record):
     """ Calculate change in an observation over a specified period.
 
     Inputs:
         obs_type:     database field name of observation concerned
         now_vt:       value of observation now (ie the finishing value)
         target_units: units our returned value must be in
-        db_manager:   manager to be used
-        then_ts:      timestamp of start of trend period
-        grace:        the largest difference in time when finding the then_ts
-                      record that is acceptable
+        then_record:  archive record at the start of the trend period, may be
+                      None
 
     Returns:
         Change in value over trend period. Can be positive, 0, negative or
@@ -1686,17 +2364,14 @@ def calc_trend(obs_type, now_vt, target_units, db_manager, then_ts, grace=0):
 
     if now_vt.value is None:
         return None
-    then_record = db_manager.getRecord(then_ts, grace)
-    if then_record is None:
+    if then_record is None or then_record.get(obs_type) is None:
         return None
-    else:
-        if obs_type not in then_record:
-            return None
-        else:
-            then_vt = weewx.units.as_value_tuple(then_record, obs_type)
-            now = convert(now_vt, target_units).value
-            then = convert(then_vt, target_units).value
-            return now - then
+    # convert both values using the cached conversion functions rather than
+    # constructing and converting ValueTuples
+    then_units = getStandardUnitType(then_record['usUnits'], obs_type)[0]
+    now = get_converter(now_vt.unit, target_units)(now_vt.value)
+    then = get_converter(then_units, target_units)(then_record[obs_type])
+    return now - then
 
 
 def calc_windrose(now, db_manager, period, points):
@@ -1718,7 +2393,7 @@ def calc_windrose(now, db_manager, period, points):
     """
 
     # initialise our result
-    rose = [0.0 for x in range(points)]
+    rose = [0.0] * points
     # get the earliest ts we will use
     ts = now - period
     # determine the factor to be used to divide numerical windDir into
@@ -1726,31 +2401,22 @@ def calc_windrose(now, db_manager, period, points):
     angle = 360.0/points
     # create an interpolation dict for our query
     inter_dict = {'table_name': db_manager.table_name,
-                  'ts': ts,
-                  'angle': angle}
-    # the query to be used
-    windrose_sql = "SELECT ROUND(windDir/%(angle)s),sum(windSpeed) "\
-                   "FROM %(table_name)s WHERE dateTime>%(ts)s "\
-                   "GROUP BY ROUND(windDir/%(angle)s)"
-
-    # we expect at least 'points' rows in our result so use genSql
-    for _row in db_manager.genSql(windrose_sql % inter_dict):
-        # for windDir==None we expect some results with None, we can ignore
-        # those
-        if _row is None or None in _row:
-            pass
-        else:
-            # Because of the structure of the compass and the limitations in
-            # SQL maths our 'North' result will be returned in 2 parts. It will
-            # be the sum of the '0' group and the 'points' group.
-            if int(_row[0]) != int(points):
-                rose[int(_row[0])] += _row[1]
-            else:
-                rose[0] += _row[1]
-    # now  round our results and return
-    return [round(x, 1) for x in rose]
-
-
-# available scroller text block classes
-EXPORTERS = {'httppost': HttpPostExport,
-             'rsync': RsyncExport}
+                  'angle': angle,
+                  'points': points}
+    # The query to be used. The binning and summing is done by the database,
+    # rows without a windDir or windSpeed cannot contribute so exclude them
+    # from the query rather than fetch and then discard them. Because of the
+    # structure of the compass our 'North' group is split in 2 parts, the '0'
+    # group and the 'points' group. Taking the group modulo points folds the
+    # two together so the database returns at most 'points' rows.
+    windrose_sql = "SELECT ROUND(windDir/%(angle)s) %% %(points)d,sum(windSpeed) "\
+                   "FROM %(table_name)s WHERE dateTime>? "\
+                   "AND windDir IS NOT NULL AND windSpeed IS NOT NULL "\
+                   "GROUP BY ROUND(windDir/%(angle)s) %% %(points)d"
+
+    # we expect up to 'points' rows in our result so use genSql, each compass
+    # point appears at most once so round each result as it is saved rather
+    # than making a second pass over the results
+    for _row in db_manager.genSql(windrose_sql % inter_dict, (ts,)):
+        rose[int(_row[0])] = round(_row[1], 1)
+    return rose